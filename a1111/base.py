@@ -1,29 +1,59 @@
+import sys
+import import_profiler
+if import_profiler.requested(sys.argv[1:]):
+    import_profiler.install()
 import os
+import json
 import subprocess
 import time
-import torch
-import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-python_version = ".".join(sys.version.split(".")[:2])
-colablib_path = f"/opt/conda/lib/python{python_version}/dist-packages/colablib"
-aiohttp_path = f"/opt/conda/lib/python{python_version}/site-packages/aiohttp-3.9.1.dist-info"
+import shutil
+import site
+import argparse
+import importlib.util
 
 def install_colablib():
-    if not os.path.exists(colablib_path):
-        subprocess.run(['pip', 'install', '-q', 'git+https://github.com/StephenZou-bot/colablib'])
+    # Into the interpreter running this script, not whichever pip is first on PATH
+    if importlib.util.find_spec("colablib") is None:
+        subprocess.run([sys.executable, '-m', 'pip', 'install', '-q', 'git+https://github.com/StephenZou-bot/colablib'])
 
 def remove_aiohttp():
-    if os.path.exists(aiohttp_path):
-        subprocess.run(['rm', '-rf', aiohttp_path])
-        
+    # The stale aiohttp 3.9.1 metadata some images ship, wherever site-packages is
+    for path in site.getsitepackages() + [site.getusersitepackages()]:
+        dist_info = os.path.join(path, "aiohttp-3.9.1.dist-info")
+        if os.path.isdir(dist_info):
+            shutil.rmtree(dist_info, ignore_errors=True)
+
 remove_aiohttp()
 install_colablib()
 
 
 from colablib.colored_print import cprint, print_line
+from scheduler import Step, run_steps, print_critical_path, skip_provided, skip_satisfied
+from probes import apt_installed, pip_installed, on_path, is_executable, binary_version, git_head, git_at_remote
+from snapshot import SnapshotRoot, SnapshotStore
+from fetch import stream_extract, save_url, segmented_download, head
+from artifact_cache import Artifact, ArtifactCache
+from persist import persist_dir, persist_budget, dir_size, room
+from git_cache import update_checkout, recently_checked
+from mirrors import MirrorTable
+from model_store import etag_sha256
+from tracing import Tracer
+from output_capture import OutputCapture, emit
+
+bin_dir = "/usr/bin"
+urls = {
+    "cloudflared": "https://github.com/cloudflare/cloudflared/releases/latest/download/cloudflared-linux-amd64",
+    "frp": "https://github.com/fatedier/frp/releases/download/v0.58.1/frp_0.58.1_linux_amd64.tar.gz",
+    "zrok": "https://github.com/openziti/zrok/releases/download/v0.4.23/zrok_0.4.23_linux_amd64.tar.gz",
+    "ui": "https://huggingface.co/datasets/Carmeninkunming/fast-repo-kaggle/resolve/main/sdw.tar.lz4",
+}
+APT_PACKAGES = {"aria2": "aria2c", "lz4": "lz4"}  # package -> the command the steps need from it
+PIP_PACKAGES = ["colorama"]
 
 def detect_environment():
+    # NOTEBOOK_ROOT lets the scripts run on a plain Linux box, e.g. for the benchmarks
+    if os.environ.get('NOTEBOOK_ROOT'):
+        return os.environ['NOTEBOOK_ROOT'], "Local"
     iskaggle = os.environ.get('KAGGLE_KERNEL_RUN_TYPE', '')
     iscolab = 'COLAB_GPU' in os.environ
     if iscolab:
@@ -34,104 +64,276 @@ def detect_environment():
         cprint('Error. Environment not detected', color="flat_red")
         exit(1)
 
-def run_command(command, description, debug=True):
+def probe_torch():
+    # torch is only imported for this banner; doing it in a throwaway interpreter keeps
+    # seconds of import time and hundreds of MB of RSS out of the notebook kernel.
+    code = "import json, torch; print(json.dumps([torch.__version__, torch.version.cuda, torch.cuda.is_available()]))"
+    result = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+    torch_ver, cuda_ver, gpu = json.loads(result.stdout.strip().splitlines()[-1])
+    is_gpu = "Yes." if gpu else "GPU not detected."
+    cprint(f"[+] PyTorch Version: {torch_ver} | Cuda: {cuda_ver} | GPU Access: {is_gpu}", color="flat_green")
+
+def run_shell(command, description, debug):
+    # Popen + wait4 rather than subprocess.run, so the rusage of this one child
+    # (its CPU time and peak RSS) can be traced even while other steps run.
+    # Output is always streamed into a bounded tail; debug also echoes it live.
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    capture = OutputCapture(description, echo=debug)
+    capture.attach(process.stdout, "flat_green")
+    capture.attach(process.stderr, "flat_red")
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    capture.join()
+    return process.returncode, usage, capture
+
+def run_command(command, description, debug=True, artifacts=(), cache=None, tracer=None, mirrors=None):
     start_time = time.time()
-    cprint(f"    > {description}", color="flat_cyan")
+    emit(f"    > {description}", color="flat_cyan")
+    trace = {"bytes": 0}
+    exit_code = None
+    capture = None
     try:
-        result = subprocess.run(command, check=True, shell=True, text=True,
-                                stdout=subprocess.PIPE if debug else subprocess.DEVNULL,
-                                stderr=subprocess.PIPE if debug else subprocess.DEVNULL)
-        if debug:
-            cprint(result.stdout, color="flat_green")
-            cprint(result.stderr, color="flat_red")
-        end_time = time.time()
-        return True, end_time - start_time
-    except subprocess.CalledProcessError as e:
-        cprint(f"Error at [{description}]: {e}", color="flat_red")
-        end_time = time.time()
-        return False, end_time - start_time
-
-def execute_commands(commands, description, debug=True):
+        for artifact in artifacts:
+            # Tools are installed into bin_dir and run as root: only one with a pinned digest may come from a mirror
+            sources = mirrors.ranked(artifact.url) if mirrors and artifact.sha256 else None
+            if cache:
+                cache.fetch(artifact, mirrors=sources)
+            else:
+                save_url(artifact.url, artifact.path, artifact.mode, mirrors=sources)
+            artifact.verify()
+            trace["bytes"] += os.path.getsize(artifact.path)
+        if command is None:
+            pass
+        elif callable(command):
+            cpu_start = time.thread_time()
+            info = command()
+            trace["cpu"] = time.thread_time() - cpu_start
+            if isinstance(info, dict):
+                trace["bytes"] += info.pop("bytes", 0)
+                trace.update(info)
+        else:
+            exit_code, usage, capture = run_shell(command, description, debug)
+            trace["cpu"] = usage.ru_utime + usage.ru_stime
+            trace["max_rss"] = usage.ru_maxrss * 1024
+            if exit_code != 0:
+                raise subprocess.CalledProcessError(exit_code, command)
+        success = True
+    except (subprocess.CalledProcessError, OSError, ValueError, RuntimeError) as e:
+        emit(f"Error at [{description}]: {e}", color="flat_red")
+        if capture:
+            capture.report()
+        success = False
+    if capture and debug and capture.summary():
+        emit(f"      [{description}] {capture.summary()}", color="flat_cyan")
+    end_time = time.time()
+    if tracer:
+        trace["exit"] = 0 if success else exit_code or 1
+        tracer.add(description, "setup", start_time, end_time, **{key: value for key, value in trace.items() if value or key == "exit"})
+    return success, end_time - start_time
+
+def install_stamp(ui_path):
+    # Written once the whole snapshot is extracted; a .git from an extraction
+    # that died halfway must not pass for an installed UI
+    return os.path.join(ui_path, ".git", "install-complete")
+
+def _clear_stamp(ui_path):
+    if os.path.exists(install_stamp(ui_path)):
+        os.remove(install_stamp(ui_path))
+
+def _write_stamp(ui_path):
+    with open(install_stamp(ui_path), "w") as f:
+        f.write(f"{time.time()}\n")
+
+def install_ui_stream(url, ui_path, cache):
+    # Extracts as it downloads, so there is no point at which a mirror's bytes
+    # could be checked before they land: always from the origin
+    _clear_stamp(ui_path)
+    received, files = stream_extract(url, ui_path, cache=cache)
+    _write_stamp(ui_path)
+    return {"bytes": received, "files": files}
+
+def install_ui_segmented(url, ui, ui_path, mirrors=None):
+    # No aria2 needed, and the .part survives a kernel restart: rerunning resumes every segment
+    # The snapshot holds the venv's executables, so mirrors are only used when
+    # the origin's ETag is the archive's sha256 and the result is checked against it
+    archive = os.path.join(ui, "sdw.tar.lz4")
+    _clear_stamp(ui_path)
+    expected = None
+    if mirrors:
+        try:
+            expected = etag_sha256(head(url).get("ETag"))
+        except OSError:
+            pass
+    size, sha256, _ = segmented_download(url, archive, connections=16, mirrors=mirrors.ranked(url) if expected else None)
+    if expected and sha256 != expected:
+        os.remove(archive)
+        raise ValueError(f"the UI snapshot does not match the sha256 {expected} its origin reports")
+    subprocess.run(["tar", "-xI", "lz4", "-f", archive, f"--directory={ui_path}"], check=True)
+    os.remove(archive)
+    _write_stamp(ui_path)
+    return {"bytes": size}
+
+def execute_commands(steps, description, max_workers=4, pool_limits=None, cache=None, tracer=None, mirrors=None):
     cprint(f"[+] {description}", color="flat_yellow")
     start_time = time.time()
-    success_count, error_count = 0, 0
-    for command, desc in commands:
-        success, command_time = run_command(command, desc, debug)
-        success_count += success
-        error_count += not success
+    results, deps = run_steps(steps, lambda step: run_command(step.command, step.description, step.debug, step.artifacts, cache, tracer, mirrors),
+                              max_workers=max_workers, pool_limits=pool_limits)
     end_time = time.time()
+    success_count = sum(result.success for result in results)
+    error_count = len(results) - success_count
     cprint(f"[+] {description} completed in: {end_time - start_time:.2f} secs", color="flat_yellow")
+    print_critical_path(results, deps)
     return success_count, error_count, end_time - start_time
 
-if __name__ == "__main__":
-    ui, env = detect_environment()
-    branch = "master"
-    ui_path = os.path.join(ui, "stable-diffusion-webui")
-    os.makedirs(ui_path, exist_ok=True)
-    git_path = os.path.join(ui_path, "extensions")
-    torch_ver = torch.__version__
-    cuda_ver = torch.version.cuda
-    is_gpu = "Yes." if torch.cuda.is_available() else "GPU not detected."
-
-    cprint(f"[+] PyTorch Version: {torch_ver} | Cuda: {cuda_ver} | GPU Access: {is_gpu}", color="flat_green")
-    print_line(0)
-
+def build_steps(ui, ui_path, branch="master", extract_mode="stream", cache=None, mirrors=None, update_mode="fast", update_ttl=3600):
+    # One apt and one pip transaction for whatever is missing; the index update
+    # only happens when apt has something to install
+    missing_apt = [package for package, command in APT_PACKAGES.items() if not apt_installed(package, command)] or list(APT_PACKAGES)
+    missing_pip = [package for package in PIP_PACKAGES if not pip_installed(package)] or PIP_PACKAGES
     initial_commands = [
-        ("apt-get update", "Update package list"),
-        ("apt -y install aria2", "Install aria2"),
-        ("apt-get install lz4", "Install lz4"),
-        ("pip install colorama", "Install colorama"),
-        ("npm install -g localtunnel", "Install localtunnel")
+        Step(probe_torch, "Probe PyTorch", provides=["torch-info"]),
+        Step(f"apt-get update && apt-get install -y {' '.join(missing_apt)}", "Install apt packages", provides=list(APT_PACKAGES.values()), pool="apt",
+             check=lambda: all(apt_installed(package, command) for package, command in APT_PACKAGES.items())),
+        Step(f"{sys.executable} -m pip install -q {' '.join(missing_pip)}", "Install pip packages", provides=PIP_PACKAGES,
+             check=lambda: all(pip_installed(package) for package in PIP_PACKAGES)),
+        Step("npm install -g localtunnel", "Install localtunnel", provides=["lt"], pool="net", check=lambda: on_path("lt"))
     ]
 
+    frp_archive = os.path.join(ui, "frp_0.58.1_linux_amd64.tar.gz")
+    zrok_archive = os.path.join(ui, "zrok_0.4.23_linux_amd64.tar.gz")
     parallel_commands = [
-        ("curl -s -Lo /usr/bin/cl https://github.com/cloudflare/cloudflared/releases/latest/download/cloudflared-linux-amd64 && chmod +x /usr/bin/cl", "Install cloudflared"),
-        ("wget https://github.com/fatedier/frp/releases/download/v0.58.1/frp_0.58.1_linux_amd64.tar.gz && tar -xzf frp_0.58.1_linux_amd64.tar.gz -C /usr/bin --strip-components=1 frp_0.58.1_linux_amd64/frpc && rm frp_0.58.1_linux_amd64.tar.gz","Install Frp"),
-        (f"cd {ui} && curl -sLO https://github.com/openziti/zrok/releases/download/v0.4.23/zrok_0.4.23_linux_amd64.tar.gz && tar -xzf zrok_0.4.23_linux_amd64.tar.gz && rm -rf zrok_0.4.23_linux_amd64.tar.gz && mv {ui}/zrok /usr/bin", "Install zrok")
+        Step(None, "Install cloudflared", provides=["cl"], pool="net", check=lambda: is_executable(os.path.join(bin_dir, "cl")),
+             artifacts=[Artifact(urls["cloudflared"], os.path.join(bin_dir, "cl"), mode=0o755)]),
+        Step(f"tar -xzf {frp_archive} -C {bin_dir} --strip-components=1 frp_0.58.1_linux_amd64/frpc && rm {frp_archive}", "Install Frp", provides=["frpc"], pool="net",
+             check=lambda: binary_version(os.path.join(bin_dir, "frpc"), ["-v"], "0.58.1"),
+             artifacts=[Artifact(urls["frp"], frp_archive, version="0.58.1")]),
+        Step(f"cd {ui} && tar -xzf {zrok_archive} && rm -rf {zrok_archive} && mv {ui}/zrok {bin_dir}", "Install zrok", provides=["zrok"], pool="net",
+             check=lambda: binary_version(os.path.join(bin_dir, "zrok"), ["version"], "0.4.23"),
+             artifacts=[Artifact(urls["zrok"], zrok_archive, version="0.4.23")])
     ]
 
-    resource_commands = [
-        (f"cd {ui} && aria2c --console-log-level=error -c -x 16 -s 16 -k 1M https://huggingface.co/datasets/Carmeninkunming/fast-repo-kaggle/resolve/main/sdw.tar.lz4 -o sdw.tar.lz4 && tar -xI lz4 -f sdw.tar.lz4 --directory={ui_path} && rm {ui}/sdw.tar.lz4", "Install UI"),
-        (f"cd {ui_path} && git reset --hard && git pull && git switch {branch} && git pull && git reset --hard", "Update UI")
+    ui_url = urls["ui"]
+    if extract_mode == "stream":
+        install_ui = Step(lambda: install_ui_stream(ui_url, ui_path, cache), "Install UI", needs=["lz4"], provides=["ui-tree"], pool="net")
+    elif extract_mode == "segmented":
+        install_ui = Step(lambda: install_ui_segmented(ui_url, ui, ui_path, mirrors), "Install UI", needs=["lz4"], provides=["ui-tree"], pool="net")
+    else:
+        install_ui = Step(f"rm -f {install_stamp(ui_path)} && cd {ui} && aria2c --console-log-level=error -c -x 16 -s 16 -k 1M {ui_url} -o sdw.tar.lz4 && tar -xI lz4 -f sdw.tar.lz4 --directory={ui_path} && rm {ui}/sdw.tar.lz4 && touch {install_stamp(ui_path)}", "Install UI", needs=["aria2c", "lz4"], provides=["ui-tree"], pool="net")
+
+    install_ui.check = lambda: os.path.exists(install_stamp(ui_path)) and git_head(ui_path) is not None
+
+    # 'fast' asks the remote for one ref and fetches only when it moved; a
+    # match within update_ttl seconds of the last one skips even that
+    update_state = os.path.join(ui, "ui_update.json")
+    if update_mode == "fast":
+        update_ui = Step(lambda: update_checkout(ui_path, branch, update_state), "Update UI", needs=["ui-tree"], provides=["ui-updated"], pool="net",
+                         check=lambda: recently_checked(ui_path, branch, update_state, update_ttl))
+    else:
+        update_ui = Step(f"cd {ui_path} && git reset --hard && git pull && git switch {branch} && git pull && git reset --hard", "Update UI", needs=["ui-tree"], provides=["ui-updated"],
+                         check=lambda: git_at_remote(ui_path, branch))
+    resource_commands = [install_ui, update_ui]
+    return initial_commands + parallel_commands + resource_commands
+
+def snapshot_roots(ui, ui_path):
+    # What a session provisions: the UI tree with its models and extensions, its
+    # venv, the tunnel binaries, the shared model store and the download bookkeeping
+    return [
+        SnapshotRoot("ui", ui_path, exclude=["venv"], provides=["ui-tree"]),
+        SnapshotRoot("venv", os.path.join(ui_path, "venv"), provides=["ui-tree"]),
+        SnapshotRoot("tools", bin_dir, names=["cl", "frpc", "zrok"], provides=["cl", "frpc", "zrok"]),
+        SnapshotRoot("model_store", os.path.join(ui, "model_store")),
+        SnapshotRoot("state", ui, names=["download_manifest.json", "model_index.json", "download_speeds.json", "link_index.json", "ui_update.json"]),
     ]
 
-    env_specific_commands = []
-#     if env == "Colab":
-#         env_specific_commands.append(("pip install xformers==0.0.25 --no-deps", "Install xformers for Colab"))
-#     elif env == "Kaggle":
-#         env_specific_commands.append(("pip install xformers==0.0.26.post1", "Install xformers for Kaggle"))
-
-    total_success, total_error, grand_total_time = 0, 0, 0
-
-    # Execute initial commands
-    success_count, error_count, total_time = execute_commands(initial_commands, "Installing initial requirements", debug=False)
-    total_success += success_count
-    total_error += error_count
-    grand_total_time += total_time
-
-    # Execute parallel commands
-    cprint(f"[+] Installing parallel commands for [{env}]", color="flat_yellow")
-    parallel_start_time = time.time()
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        future_to_command = {executor.submit(run_command, cmd, desc, False): desc for cmd, desc in parallel_commands}
-        for future in as_completed(future_to_command):
-            desc = future_to_command[future]
-            try:
-                success, command_time = future.result()
-                total_success += success
-                total_error += not success
-                grand_total_time += command_time
-            except Exception as exc:
-                cprint(f'Command {desc} generated an exception: {exc}', color="flat_red")
-                total_error += 1
-    parallel_end_time = time.time()
-    cprint(f"[+] Parallel commands completed in: {parallel_end_time - parallel_start_time:.2f} secs", color="flat_yellow")
-
-    # Execute resource and environment-specific commands
-    success_count, error_count, total_time = execute_commands(resource_commands + env_specific_commands, "Installing resource commands", debug=False)
-    total_success += success_count
-    total_error += error_count
-    grand_total_time += total_time
-
-    print_line(0)
-    cprint(f"[+] {total_error} of {total_success + total_error} commands failed. All completed within: {grand_total_time:.2f} secs", color="flat_yellow")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set up the WebUI environment.")
+    parser.add_argument("--max_workers", type=int, default=4, help="How many setup steps may run at the same time.")
+    parser.add_argument("--net_workers", type=int, default=4, help="How many download steps may run at the same time.")
+    parser.add_argument("--extract_mode", choices=["stream", "download", "segmented"], default="stream",
+                        help="'stream' pipes the UI snapshot straight into extraction, 'download' saves the archive with aria2 first, "
+                             "'segmented' saves it with the built-in resumable downloader.")
+    parser.add_argument("--update_mode", choices=["fast", "pull"], default="fast",
+                        help="'fast' checks the remote head and fetches only a changed commit, 'pull' resets and pulls the whole checkout.")
+    parser.add_argument("--update_ttl", type=float, default=60, help="Minutes after a successful update check during which the UI is not checked again.")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Where downloaded tools and UI snapshots are kept between sessions.")
+    parser.add_argument("--cache_budget_gb", type=float, default=8, help="Size limit of the artifact cache, 0 disables it.")
+    parser.add_argument("--mirrors", type=str, default="", help='Mirror table: "default" for the built-in huggingface/github mirrors, '
+                        "or a JSON file mapping URL prefixes to mirror prefixes (default: $NOTEBOOK_MIRRORS, else off). "
+                        "Tools without a pinned sha256 and the streamed UI snapshot always come from their origin.")
+    parser.add_argument("--snapshot_dir", type=str, default=None, help="Where session snapshots are kept (default: /kaggle/working/.snapshots on Kaggle).")
+    parser.add_argument("--save_snapshot", action="store_true", help="Snapshot the provisioned environment and exit.")
+    parser.add_argument("--snapshot_skip", type=str, default="model_store,venv",
+                        help="Comma-separated roots left out of a new snapshot (ui, venv, tools, model_store, state); "
+                             "the model store and the venv by default, they rarely fit the persistent disk.")
+    parser.add_argument("--persist_budget_gb", type=float, default=None,
+                        help="What the snapshots, the artifact cache and the git cache may take together on the persistent disk "
+                             "(default: $NOTEBOOK_PERSIST_BUDGET_GB, else 16; Kaggle keeps 20 GB of /kaggle/working).")
+    parser.add_argument("--no_skip", action="store_true", help="Run every step even when its postcondition already holds.")
+    parser.add_argument("--no_restore", action="store_true", help="Run every step even when a snapshot could stand in for it.")
+    parser.add_argument("--trace", type=str, default="setup_trace.json", help="Where to write the Chrome trace of the setup steps.")
+    parser.add_argument("--profile_imports", "--profile-imports", action="store_true", help="Report the time spent importing each module.")
+    try:
+        args = parser.parse_args()
+        if args.max_workers < 1 or args.net_workers < 1:
+            parser.error("--max_workers and --net_workers must be at least 1")
+
+        ui, env = detect_environment()
+        budget = persist_budget(args.persist_budget_gb)
+        cache_dir = args.cache_dir or persist_dir(ui, env, ".artifact_cache")
+        snapshot_dir = args.snapshot_dir or persist_dir(ui, env, ".snapshots")
+        git_cache_dir = persist_dir(ui, env, ".git_cache")  # filled by pastebin.py
+        cache = None
+        if args.cache_budget_gb > 0:
+            # Never more than what it holds now plus what the shared budget has left
+            cache_budget = dir_size(cache_dir) + room(cache_dir, budget, [snapshot_dir, git_cache_dir])
+            cache = ArtifactCache(cache_dir, min(int(args.cache_budget_gb * (1 << 30)), cache_budget))
+        mirrors = MirrorTable.load(args.mirrors)
+        branch = "master"
+        ui_path = os.path.join(ui, "stable-diffusion-webui")
+        snapshots = SnapshotStore(snapshot_dir, budget, [cache_dir, git_cache_dir])
+        roots = snapshot_roots(ui, ui_path)
+        if args.save_snapshot:
+            skip = set(args.snapshot_skip.split(","))
+            snapshots.save([root for root in roots if root.name not in skip])
+            raise SystemExit(0)
+        os.makedirs(ui_path, exist_ok=True)
+        git_path = os.path.join(ui_path, "extensions")
+
+        # apt/dpkg holds a global lock, so apt steps are serialised in their own pool
+        pool_limits = {"apt": 1, "net": args.net_workers}
+
+        env_specific_commands = []
+    #     if env == "Colab":
+    #         env_specific_commands.append(Step("pip install xformers==0.0.25 --no-deps", "Install xformers for Colab", needs=["ui-tree"]))
+    #     elif env == "Kaggle":
+    #         env_specific_commands.append(Step("pip install xformers==0.0.26.post1", "Install xformers for Kaggle", needs=["ui-tree"]))
+
+        # One dependency graph instead of three fixed phases: the UI tarball only waits
+        # for aria2/lz4, not for localtunnel or the tunnel binaries.
+        # The newest snapshot goes first; steps whose outputs it brought back are dropped
+        tracer = Tracer("setup")
+        restored = set()
+        if not args.no_restore:
+            restore_start = time.time()
+            restored = snapshots.restore(roots)
+            tracer.add("Restore snapshot", "setup", restore_start, time.time(), exit=0)
+        steps = skip_provided(build_steps(ui, ui_path, branch, args.extract_mode, cache, mirrors, args.update_mode, args.update_ttl * 60) + env_specific_commands, restored)
+        if not args.no_skip:
+            steps, satisfied = skip_satisfied(steps)
+            if satisfied:
+                cprint(f"[+] Already in place, skipped: {', '.join(step.description for step in satisfied)}", color="flat_green")
+        total_success, total_error, grand_total_time = execute_commands(steps, f"Installing requirements for [{env}]",
+                                                                        max_workers=args.max_workers, pool_limits=pool_limits,
+                                                                        cache=cache, tracer=tracer, mirrors=mirrors)
+
+        print_line(0)
+        tracer.print_summary()
+        tracer.write(args.trace)
+        cprint(f"[+] Trace written to {os.path.abspath(args.trace)}", color="flat_yellow")
+        cache_summary = f" {cache.summary()}." if cache else ""
+        cprint(f"[+] {total_error} of {total_success + total_error} commands failed. All completed within: {grand_total_time:.2f} secs.{cache_summary}", color="flat_yellow")
+        if args.profile_imports:
+            import_profiler.report()
+    finally:
+        # Installed before anything else ran; a run that raised must not leave it on in the kernel
+        import_profiler.uninstall()
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from colablib.colored_print import cprint
+
+class LinkIndex:
+    # Per input dataset, one entry per directory already mirrored: the mtime of
+    # the source and target directory at that point, the files in it and the
+    # subdirectories that were walked (whole-directory links are not walked).
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.datasets = json.load(f)
+        except (OSError, ValueError):
+            self.datasets = {}
+
+    def get(self, input_dir, output_dir):
+        dataset = self.datasets.get(input_dir)
+        if not dataset or dataset.get("output") != output_dir:
+            return {}
+        return dataset["dirs"]
+
+    def put(self, input_dir, output_dir, dirs):
+        self.datasets[input_dir] = {"output": output_dir, "dirs": dirs}
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.datasets, f, indent=1)
+        os.replace(tmp, self.path)
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _is_empty_dir(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        return False
+    with os.scandir(path) as entries:
+        return next(entries, None) is None
+
+def link_tree(input_dir, output_dir, index, workers=8):
+    # Symlinks every file under input_dir into output_dir. A directory that is
+    # missing or empty on the target side becomes one symlink to the source
+    # directory instead of a walk; the top level always stays a real directory
+    # so later downloads can still land next to the linked files.
+    old = index.get(input_dir, output_dir)
+    new = {}
+    stats = {"linked": 0, "dirs": 0, "skipped": 0, "unchanged": 0}
+    lock = threading.Lock()
+
+    def count(**values):
+        with lock:
+            for key, value in values.items():
+                stats[key] += value
+
+    def process(rel):
+        src = os.path.join(input_dir, rel) if rel else input_dir
+        dst = os.path.join(output_dir, rel) if rel else output_dir
+        entry = old.get(rel)
+        src_mtime = _mtime(src)
+        if entry and entry["mtime"] == src_mtime and entry["target_mtime"] == _mtime(dst):
+            # Nothing added or removed on either side since the last run
+            with lock:
+                new[rel] = entry
+                stats["unchanged"] += entry["files"]
+            return [os.path.join(rel, name) for name in entry["dirs"]]
+
+        os.makedirs(dst, exist_ok=True)
+        walked, files, linked, linked_dirs, skipped = [], 0, 0, 0, 0
+        with os.scandir(src) as entries:
+            for item in entries:
+                target = os.path.join(dst, item.name)
+                if item.is_dir():
+                    if _is_empty_dir(target):
+                        os.rmdir(target)
+                    try:
+                        os.symlink(item.path, target, target_is_directory=True)
+                        linked_dirs += 1
+                    except FileExistsError:
+                        if not os.path.islink(target):
+                            walked.append(item.name)
+                    continue
+                files += 1
+                try:
+                    os.symlink(item.path, target)
+                    linked += 1
+                except FileExistsError:
+                    skipped += 1
+        count(linked=linked, dirs=linked_dirs, skipped=skipped)
+        with lock:
+            new[rel] = {"mtime": src_mtime, "target_mtime": _mtime(dst), "files": files, "dirs": walked}
+        return [os.path.join(rel, name) for name in walked]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(process, "")}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for rel in future.result():
+                    pending.add(executor.submit(process, rel))
+
+    index.put(input_dir, output_dir, new)
+    return stats
+
+def link_datasets(datasets, index_path, workers=8):
+    index = LinkIndex(index_path)
+    for input_dir, output_dir in datasets.items():
+        if not os.path.isdir(input_dir):
+            cprint(f"[-] {input_dir} not found, skipping.", color="flat_yellow")
+            continue
+        start_time = time.time()
+        stats = link_tree(input_dir, os.path.normpath(output_dir), index, workers)
+        index.save()
+        cprint(f"[+] Linked {input_dir} to {output_dir}: {stats['linked']} files and {stats['dirs']} directories linked, "
+               f"{stats['skipped']} existing skipped, {stats['unchanged']} unchanged, in {time.time() - start_time:.2f} secs.",
+               color="flat_green")
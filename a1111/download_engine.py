@@ -0,0 +1,204 @@
+import os
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from colablib.colored_print import cprint
+from fetch import head, range_probe
+
+# civitai starts answering 429 well before huggingface does
+HOST_LIMITS = {
+    "civitai.com": 2,
+    "huggingface.co": 4,
+    "github.com": 4,
+}
+DEFAULT_HOST_LIMIT = 3
+
+@dataclass(eq=False)
+class DownloadJob:
+    category: str
+    url: str
+    filename: str
+    dst: str
+    size: int = None
+    etag: str = None
+    auth: dict = None
+
+    @property
+    def host(self):
+        return host_of(self.url)
+
+    @property
+    def path(self):
+        return os.path.join(self.dst, self.filename) if self.filename else self.dst
+
+@dataclass
+class JobResult:
+    job: DownloadJob
+    success: bool
+    start: float
+    end: float
+    size: int = 0
+    error: str = None
+
+    @property
+    def elapsed(self):
+        return self.end - self.start
+
+def host_of(url):
+    host = (urlparse(url).hostname or "").lower()
+    for known in HOST_LIMITS:
+        if host == known or host.endswith("." + known):
+            return known
+    return host
+
+def strip_credentials(url):
+    # A key pasted into a civitai URL (?ApiKey=... or ?token=...) comes out of
+    # it and travels as a header instead. Returns (url without it, key or None).
+    parts = urlsplit(url)
+    if host_of(url) != "civitai.com" or not parts.query:
+        return url, None
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    keys = [value for name, value in query if name.lower() in ("apikey", "token")]
+    if not keys:
+        return url, None
+    query = [(name, value) for name, value in query if name.lower() not in ("apikey", "token")]
+    return urlunsplit(parts._replace(query=urlencode(query))), keys[0]
+
+def probe_sizes(jobs, headers_for=None, workers=16):
+    # Content-Length via HEAD, concurrently, then a one-byte range GET for the
+    # servers that refuse HEAD or leave the length out; unknown sizes stay None and sort last
+    def probe(job):
+        auth = headers_for(job) if headers_for else job.auth
+        try:
+            headers = head(job.url, headers=auth)
+            length = headers.get("Content-Length")
+            job.size = int(length) if length else None
+            job.etag = headers.get("ETag")
+        except (OSError, ValueError):
+            job.size = None
+        if job.size is None:
+            try:
+                job.size, etag = range_probe(job.url, headers=auth)
+                job.etag = job.etag or etag
+            except (OSError, ValueError):
+                job.size = None
+
+    probed = [job for job in jobs if job.size is None and urlparse(job.url).scheme in ("http", "https")]
+    if probed:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(probe, probed))
+
+class DownloadEngine:
+    def __init__(self, max_workers=4, host_limits=None, default_host_limit=DEFAULT_HOST_LIMIT):
+        self.max_workers = max_workers
+        self.host_limits = {**HOST_LIMITS, **(host_limits or {})}
+        self.default_host_limit = default_host_limit
+
+    def _limit(self, host):
+        return self.host_limits.get(host, self.default_host_limit)
+
+    def run(self, jobs, worker, tracer=None, budget=None):
+        # Largest first so multi-GB checkpoints start immediately; each worker
+        # takes the biggest remaining job whose host still has a free slot.
+        # One queue per host keeps a pick O(hosts) for lists of thousands of files.
+        # With a `budget` (planner.DiskBudget) a job only starts once it fits on
+        # its disk; what still cannot fit with nothing running fails right away.
+        queues = {}
+        for job in sorted(jobs, key=lambda job: job.size or 0, reverse=True):
+            queues.setdefault(job.host, deque()).append(job)
+        pending = len(jobs)
+        active = {}
+        results = []
+        cond = threading.Condition()
+
+        def admissible(host):
+            if budget is None:
+                return queues[host][0]
+            return next((job for job in queues[host] if budget.fits(job)), None)
+
+        def next_job():
+            nonlocal pending
+            with cond:
+                while True:
+                    if not pending:
+                        return None, False
+                    free = [host for host, queue in queues.items() if queue and active.get(host, 0) < self._limit(host)]
+                    candidates = [job for job in map(admissible, free) if job is not None]
+                    if candidates:
+                        job = max(candidates, key=lambda job: job.size or 0)
+                        queues[job.host].remove(job)
+                        active[job.host] = active.get(job.host, 0) + 1
+                        pending -= 1
+                        if budget:
+                            budget.reserve(job)
+                        return job, True
+                    if free and not any(active.values()):
+                        # Nothing running can make room for it any more
+                        job = queues[free[0]].popleft()
+                        active[job.host] = active.get(job.host, 0) + 1
+                        pending -= 1
+                        return job, False
+                    cond.wait()
+
+        def loop():
+            while True:
+                job, admitted = next_job()
+                if job is None:
+                    return
+                start = time.time()
+                success, error = True, None
+                try:
+                    if not admitted:
+                        raise OSError(budget.shortfall(job))
+                    worker(job)
+                except Exception as e:
+                    success, error = False, str(e)
+                    cprint(f"Error downloading [{job.url}]: {e}", color="flat_red")
+                size = _size_on_disk(job.path) if success and job.filename else 0
+                end = time.time()
+                if tracer:
+                    tracer.add(job.filename or job.url, job.category, start, end, exit=0 if success else 1, bytes=size, url=job.url, error=error)
+                with cond:
+                    active[job.host] -= 1
+                    if budget and admitted:
+                        budget.release(job)
+                    results.append(JobResult(job, success, start, end, size, error))
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=loop, daemon=True) for _ in range(min(self.max_workers, pending))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+def _size_on_disk(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _format_size(size):
+    return f"{size / (1 << 20):.1f} MB"
+
+def print_summary(results, elapsed):
+    for result in sorted(results, key=lambda result: result.elapsed, reverse=True):
+        job = result.job
+        speed = result.size / result.elapsed / (1 << 20) if result.elapsed > 0 else 0
+        status = "ok" if result.success else "failed"
+        cprint(f"    {result.elapsed:7.1f}s  {_format_size(result.size):>10}  {speed:6.1f} MB/s  {status:<6}  {job.category}: {job.filename or job.url}",
+               color="flat_green" if result.success else "flat_red")
+    total = sum(result.size for result in results)
+    failed = sum(not result.success for result in results)
+    throughput = total / elapsed / (1 << 20) if elapsed > 0 else 0
+    cprint(f"[+] {len(results) - failed} of {len(results)} downloads succeeded, {_format_size(total)} at {throughput:.1f} MB/s overall.",
+           color="flat_yellow" if not failed else "flat_red")
@@ -0,0 +1,818 @@
+import os
+import json
+import time
+import shutil
+import email.message
+import hashlib
+import subprocess
+import tarfile
+import zipfile
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+USER_AGENT = "sd-webui-notebook"
+CHUNK_SIZE = 1 << 20
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    # Credentials are for the host they were given for: a redirect to a CDN
+    # or signed S3 URL goes out without them. HEAD stays HEAD; urllib would
+    # turn a redirected HEAD into a GET and start downloading the body.
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new is not None:
+            if req.get_method() == "HEAD":
+                new.method = "HEAD"
+            if urllib.parse.urlparse(newurl).netloc != urllib.parse.urlparse(req.full_url).netloc:
+                new.headers.pop("Authorization", None)
+        return new
+
+_opener = urllib.request.build_opener(_RedirectHandler)
+
+def open_url(url, headers=None, timeout=30):
+    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT, **(headers or {})})
+    return _opener.open(request, timeout=timeout)
+
+def save_stream(source, path, mode=None):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            shutil.copyfileobj(source, f, CHUNK_SIZE)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def save_url(url, path, mode=None, headers=None, mirrors=None, min_rate=0):
+    with open_mirrored(url, mirrors, headers, min_rate) as response:
+        save_stream(response, path, mode)
+
+def download_file(url, path, headers=None, etag=None, progress=None):
+    # Writes into `path`.part and hashes while writing, so verification never
+    # needs a second read of the file. An existing .part is resumed with a Range
+    # request; If-Range makes the server restart from zero when the file changed.
+    # `progress` is called with the size of every piece written. Returns (size, sha256, etag).
+    part = path + ".part"
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    request_headers = dict(headers or {})
+    if offset:
+        request_headers["Range"] = f"bytes={offset}-"
+        if etag:
+            request_headers["If-Range"] = etag
+    try:
+        response = open_url(url, headers=request_headers)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        # The .part is no prefix of the current file any more
+        os.remove(part)
+        return download_file(url, path, headers, etag, progress)
+
+    hasher = hashlib.sha256()
+    with response:
+        if offset and response.status == 206:
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+            mode = "ab"
+            if progress:
+                progress(offset)
+        else:
+            offset, mode = 0, "wb"
+        length = response.headers.get("Content-Length")
+        expected = offset + int(length) if length else None
+        size = offset
+        with open(part, mode) as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+                hasher.update(chunk)
+                size += len(chunk)
+                if progress:
+                    progress(len(chunk))
+        etag = response.headers.get("ETag") or etag
+
+    if expected is not None and size != expected:
+        raise OSError(f"Connection closed at {size} of {expected} bytes, rerun to resume {part}")
+    os.replace(part, path)
+    return size, hasher.hexdigest(), etag
+
+def head(url, headers=None, timeout=10):
+    request = urllib.request.Request(url, method="HEAD", headers={"User-Agent": USER_AGENT, **(headers or {})})
+    with _opener.open(request, timeout=timeout) as response:
+        return response.headers
+
+def range_probe(url, headers=None, timeout=10):
+    # GET of the first byte, for servers that refuse HEAD (signed S3 URLs are
+    # signed for GET only) or leave out Content-Length. Returns (size, etag).
+    with open_url(url, headers={**(headers or {}), "Range": "bytes=0-0"}, timeout=timeout) as response:
+        content_range = response.headers.get("Content-Range", "")
+        etag = response.headers.get("ETag")
+        if response.status == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            return (int(total) if total.isdigit() else None), etag
+        length = response.headers.get("Content-Length")
+        return (int(length) if length else None), etag
+
+def content_filename(url, headers=None, timeout=10):
+    # The name the server gives the file (Content-Disposition), else the last
+    # path segment after redirects; a one-byte GET, since signed URLs refuse HEAD
+    with open_url(url, headers={**(headers or {}), "Range": "bytes=0-0"}, timeout=timeout) as response:
+        message = email.message.Message()
+        message["Content-Disposition"] = response.headers.get("Content-Disposition", "")
+        filename = message.get_filename()
+        final_url = response.geturl()
+    return os.path.basename(filename or urllib.parse.unquote(urllib.parse.urlparse(final_url).path))
+
+def resolve(url, headers=None, timeout=10):
+    # HEAD with redirects followed; returns (final URL, response headers) so
+    # range requests go straight to the CDN instead of through the API each
+    # time. Servers that refuse HEAD (signed S3 URLs are signed for GET only)
+    # get a one-byte range GET, answered with the headers a HEAD would have had.
+    request = urllib.request.Request(url, method="HEAD", headers={"User-Agent": USER_AGENT, **(headers or {})})
+    try:
+        with _opener.open(request, timeout=timeout) as response:
+            return response.geturl(), response.headers
+    except urllib.error.HTTPError as e:
+        if e.code not in (400, 403, 405, 501):
+            raise
+    with open_url(url, headers={**(headers or {}), "Range": "bytes=0-0"}, timeout=timeout) as response:
+        content_range = response.headers.get("Content-Range", "")
+        response_headers = {key: value for key in ("ETag", "Last-Modified") if (value := response.headers.get(key))}
+        if response.status == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            if total.isdigit():
+                response_headers["Content-Length"] = total
+            response_headers["Accept-Ranges"] = "bytes"
+        elif response.headers.get("Content-Length"):
+            response_headers["Content-Length"] = response.headers["Content-Length"]
+        return response.geturl(), response_headers
+
+class _Segment:
+    def __init__(self, start, end, pos=None):
+        self.start = start
+        self.end = end
+        self.pos = start if pos is None else pos
+        self.active = False
+
+    @property
+    def remaining(self):
+        return self.end - self.pos
+
+class _SegmentedDownload:
+    # Shared state of one segmented download: the segments, the .part file
+    # and a sidecar .part.json that lets the next kernel resume every segment.
+    def __init__(self, url, path, size, etag, connections, min_segment):
+        self.url = url
+        self.path = path
+        self.part = path + ".part"
+        self.state_path = self.part + ".json"
+        self.size = size
+        self.etag = etag
+        self.connections = connections
+        self.min_segment = min_segment
+        self.lock = threading.Lock()
+        self.saved = 0.0
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.hash_lock = threading.Lock()
+        self.segments = self._load() or self._split()
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if state and state["size"] == self.size and (not self.etag or state["etag"] == self.etag) and os.path.exists(self.part):
+            return [_Segment(start, end, pos) for start, end, pos in state["segments"]]
+        if not state and os.path.exists(self.part) and os.path.getsize(self.part) <= self.size:
+            # A .part left by the single-stream download_file: its bytes are a finished prefix
+            done = os.path.getsize(self.part)
+            return [_Segment(0, done, done)] + self._split(done)
+        return None
+
+    def _split(self, offset=0):
+        remaining = self.size - offset
+        count = max(1, min(self.connections, remaining // self.min_segment))
+        bounds = [offset + remaining * index // count for index in range(count + 1)]
+        return [_Segment(bounds[index], bounds[index + 1]) for index in range(count)]
+
+    def save(self, force=False):
+        with self.lock:
+            if not force and time.time() - self.saved < 1.0:
+                return
+            self.saved = time.time()
+            state = {"url": self.url, "size": self.size, "etag": self.etag,
+                     "segments": [[segment.start, segment.end, segment.pos] for segment in self.segments]}
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def next_segment(self):
+        # An untouched segment if there is one, otherwise steal the back half of
+        # the largest one still running; splitting stops at `min_segment`.
+        with self.lock:
+            for segment in self.segments:
+                if not segment.active and segment.remaining > 0:
+                    segment.active = True
+                    return segment
+            running = max((segment for segment in self.segments if segment.active), key=lambda segment: segment.remaining, default=None)
+            if running is None or running.remaining < 2 * self.min_segment:
+                return None
+            middle = running.pos + running.remaining // 2
+            stolen = _Segment(middle, running.end)
+            stolen.active = True
+            running.end = middle
+            self.segments.append(stolen)
+            self.segments.sort(key=lambda segment: segment.start)
+            return stolen
+
+    def finished(self, segment):
+        with self.lock:
+            segment.active = False
+
+    def advance_hash(self, fd, final=False):
+        # The hash cursor follows the contiguous finished prefix of the file;
+        # those pages were just written, so the re-read hits the page cache.
+        if not self.hash_lock.acquire(blocking=final):
+            return
+        try:
+            with self.lock:
+                frontier = self.size
+                for segment in self.segments:
+                    if segment.remaining > 0:
+                        frontier = min(frontier, segment.pos)
+            while self.hashed < frontier:
+                chunk = os.pread(fd, min(CHUNK_SIZE, frontier - self.hashed), self.hashed)
+                if not chunk:
+                    break
+                self.hasher.update(chunk)
+                self.hashed += len(chunk)
+        finally:
+            self.hash_lock.release()
+
+class _RateWatch:
+    # Bytes per second over the last `window` seconds, summed over every
+    # connection; a source only counts as too slow after a full window on it
+    def __init__(self, min_rate, window=5.0):
+        self.min_rate = min_rate
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.since = time.time()
+            self.events = deque()
+            self.total = 0
+
+    def _expire(self, now):
+        while self.events and self.events[0][0] < now - self.window:
+            self.total -= self.events.popleft()[1]
+
+    def add(self, size):
+        now = time.time()
+        with self.lock:
+            self.events.append((now, size))
+            self.total += size
+            self._expire(now)
+
+    def too_slow(self):
+        if not self.min_rate:
+            return False
+        now = time.time()
+        with self.lock:
+            if now - self.since < self.window:
+                return False
+            self._expire(now)
+            return self.total / self.window < self.min_rate
+
+def _host(url):
+    return urllib.parse.urlparse(url).netloc
+
+class _Sources:
+    # The URLs one file can be fetched from, best first. Credentials only go
+    # to the host of the URL the caller asked for. The current source moves
+    # on when it fails twice in a row or is found too slow; the first worker
+    # to report the source it was using moves everyone.
+    def __init__(self, url, mirrors, headers):
+        self.url = url
+        self.urls = list(mirrors or [url])
+        self.headers = headers
+        self.lock = threading.Lock()
+        self.index = -1
+        self.failures = 0
+        self.size = None  # once known, sources that report another size are passed over
+        self.final_url = None
+        self.request_headers = None
+        self.response_headers = None
+
+    def headers_for(self, candidate):
+        return self.headers if _host(candidate) == _host(self.url) else None
+
+    def _advance(self):
+        while self.index + 1 < len(self.urls):
+            self.index += 1
+            candidate = self.urls[self.index]
+            try:
+                final_url, response_headers = resolve(candidate, self.headers_for(candidate))
+            except (OSError, ValueError):
+                continue
+            length = response_headers.get("Content-Length")
+            if self.size is not None and length and int(length) != self.size:
+                continue
+            self.final_url = final_url
+            # Signed CDN URLs reject credentials meant for the API host
+            self.request_headers = self.headers_for(candidate) if _host(final_url) == _host(candidate) else None
+            self.response_headers = response_headers
+            self.failures = 0
+            return True
+        return False
+
+    def start(self):
+        with self.lock:
+            if not self._advance():
+                raise OSError(f"None of the {len(self.urls)} sources of {self.url} answered")
+
+    @property
+    def current_url(self):
+        return self.urls[self.index]
+
+    def current(self):
+        # (index, URL to request, headers, ETag for If-Range) of the source in use
+        with self.lock:
+            return self.index, self.final_url, self.request_headers, self.response_headers.get("ETag")
+
+    def switch(self, index):
+        with self.lock:
+            if index != self.index:
+                return True
+            return self._advance()
+
+    def failed(self, index):
+        with self.lock:
+            if index != self.index:
+                return True
+            self.failures += 1
+            return self.failures >= 2 and self._advance()
+
+class MirrorReader:
+    # A response body that outlives its source: on an error, an early end or a
+    # rate under `min_rate` it reopens the next source with a Range from the
+    # current offset, so a consumer streaming it never sees the switch.
+    def __init__(self, url, mirrors=None, headers=None, min_rate=0, timeout=30):
+        self.sources = _Sources(url, mirrors, headers)
+        self.sources.start()
+        length = self.sources.response_headers.get("Content-Length")
+        self.size = self.sources.size = int(length) if length else None
+        self.watch = _RateWatch(min_rate)
+        self.timeout = timeout
+        self.offset = 0
+        self.index = self.sources.index
+        try:
+            self.response = self._request()
+        except (OSError, ValueError) as e:
+            self.response = None
+            if not self._switch():
+                raise e
+
+    def _request(self):
+        _, target, request_headers, etag = self.sources.current()
+        request_headers = dict(request_headers or {})
+        if self.offset:
+            request_headers["Range"] = f"bytes={self.offset}-"
+            if etag:
+                request_headers["If-Range"] = etag
+        response = open_url(target, headers=request_headers, timeout=self.timeout)
+        if self.offset and response.status != 206:
+            response.close()
+            raise ValueError("source ignored the Range request")
+        return response
+
+    def _switch(self):
+        # Opens the next source that answers; the old response is only closed once there is one
+        while self.sources.switch(self.index) and self.sources.index != self.index:
+            self.index = self.sources.index
+            try:
+                response = self._request()
+            except (OSError, ValueError):
+                continue
+            if self.response:
+                self.response.close()
+            self.response = response
+            self.watch.reset()
+            return True
+        return False
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(CHUNK_SIZE), b""))
+        parts = []
+        while size > 0:
+            try:
+                data = self.response.read1(size)
+                if not data and self.size is not None and self.offset < self.size:
+                    raise OSError(f"connection closed at byte {self.offset}")
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                if not self._switch():
+                    raise
+                continue
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+            self.offset += len(data)
+            self.watch.add(len(data))
+            if self.watch.too_slow():
+                self._switch()
+        return b"".join(parts)
+
+    def close(self):
+        if self.response:
+            self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_mirrored(url, mirrors=None, headers=None, min_rate=0):
+    # `mirrors` are the URLs of the same file, best first (mirrors.MirrorTable.ranked)
+    if not mirrors:
+        return open_url(url, headers=headers)
+    return MirrorReader(url, mirrors, headers, min_rate)
+
+def segmented_download(url, path, headers=None, etag=None, connections=8, min_segment=4 << 20, retries=5, mirrors=None, min_rate=0,
+                       progress=None):
+    # Parallel Range requests into one preallocated .part file, each segment
+    # retried on its own. Falls back to download_file when the server has no
+    # ranges or the file is too small to split. With `mirrors` (the URLs of
+    # the same file, best first) every connection moves to the next one when
+    # a source keeps failing or the combined rate stays under `min_rate` for
+    # a whole window. `progress` is called with the size of every piece
+    # written, resumed ones included. Returns (size, sha256, etag).
+    sources = _Sources(url, mirrors, headers)
+    try:
+        sources.start()
+    except OSError:
+        # Nothing answered the probe; a plain GET may still work
+        return download_file(url, path, headers, etag, progress)
+    response_headers = sources.response_headers
+    length = response_headers.get("Content-Length")
+    size = int(length) if length else None
+    etag = response_headers.get("ETag") or etag
+    if size is None or response_headers.get("Accept-Ranges", "").lower() != "bytes" or size < 2 * min_segment:
+        if os.path.exists(path + ".part.json"):
+            # A segmented .part has holes; the single-stream resume would treat it as a prefix
+            os.remove(path + ".part.json")
+            os.remove(path + ".part")
+        return download_file(sources.current_url, path, sources.headers_for(sources.current_url), etag, progress)
+    sources.size = size
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    download = _SegmentedDownload(url, path, size, etag, connections, min_segment)
+    watch = _RateWatch(min_rate)
+    fd = os.open(download.part, os.O_RDWR | os.O_CREAT)
+    errors = []
+    if progress:
+        progress(size - sum(max(segment.remaining, 0) for segment in download.segments))
+    try:
+        os.ftruncate(fd, size)
+
+        def fetch(segment, source):
+            # Returns early, with the segment unfinished, when the source is switched
+            index, target, request_headers, if_range = source
+            request_headers = {**(request_headers or {}), "Range": f"bytes={segment.pos}-{segment.end - 1}"}
+            if if_range:
+                request_headers["If-Range"] = if_range
+            with open_url(target, headers=request_headers) as response:
+                if response.status != 206:
+                    raise ValueError("server ignored the Range request")
+                while segment.remaining > 0:
+                    chunk = response.read1(min(CHUNK_SIZE, segment.remaining))
+                    if not chunk:
+                        raise OSError(f"connection closed at byte {segment.pos}")
+                    # segment.end may shrink under us when another worker steals the tail
+                    chunk = chunk[:max(segment.remaining, 0)]
+                    os.pwrite(fd, chunk, segment.pos)
+                    segment.pos += len(chunk)
+                    download.save()
+                    download.advance_hash(fd)
+                    watch.add(len(chunk))
+                    if progress:
+                        progress(len(chunk))
+                    if sources.index != index:
+                        return
+                    if watch.too_slow() and sources.switch(index):
+                        watch.reset()
+                        return
+
+        def worker():
+            while not errors:
+                segment = download.next_segment()
+                if segment is None:
+                    return
+                attempt = 0
+                while True:
+                    source = sources.current()
+                    try:
+                        fetch(segment, source)
+                        break
+                    except (OSError, ValueError, http.client.HTTPException) as e:
+                        if len(sources.urls) > 1 and sources.failed(source[0]):
+                            continue
+                        if isinstance(e, ValueError) or attempt == retries:
+                            errors.append(e)
+                            break
+                        time.sleep(min(2 ** attempt, 10))
+                        attempt += 1
+                download.finished(segment)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        download.save(force=True)
+        if errors:
+            raise OSError(f"{errors[0]}, rerun to resume {download.part}")
+        download.advance_hash(fd, final=True)
+    finally:
+        os.close(fd)
+    os.replace(download.part, path)
+    os.remove(download.state_path)
+    return size, download.hasher.hexdigest(), etag
+
+def _decompressor(url):
+    name = url.split("?")[0]
+    if name.endswith(".lz4"):
+        return ["lz4", "-dc"]
+    if name.endswith((".zst", ".zstd")):
+        return ["zstd", "-dc"]
+    return None
+
+def _safe_join(root, name):
+    path = os.path.normpath(os.path.join(root, name))
+    if os.path.isabs(name) or not (path == root or path.startswith(root + os.sep)):
+        raise ValueError(f"Refusing to extract outside of {root}: {name}")
+    return path
+
+class _LinkGuard:
+    # Lexical checks miss links: "a -> /elsewhere" followed by "a/file" would
+    # write outside root. Every parent is resolved (cached until the next
+    # symlink is made) and every link target must resolve inside root.
+    def __init__(self, root):
+        self.top = root
+        self.root = os.path.realpath(root)
+        self.safe = set()
+
+    def _check(self, path, name):
+        if not (path == self.root or path.startswith(self.root + os.sep)):
+            raise ValueError(f"Refusing to extract outside of {self.root}: {name}")
+
+    def parent(self, path, name):
+        parent = os.path.dirname(path)
+        if path != self.top and parent not in self.safe:
+            self._check(os.path.realpath(parent), name)
+            self.safe.add(parent)
+
+    def resolved(self, path, name):
+        self._check(os.path.realpath(path), name)
+
+    def symlink(self, path, target, name):
+        if os.path.isabs(target):
+            raise ValueError(f"Refusing absolute link target {target}: {name}")
+        self._check(os.path.realpath(os.path.join(os.path.dirname(path), target)), name)
+        self.safe.clear()
+
+class _ParallelWriter:
+    # Small members are buffered and written by a thread pool while the tar
+    # stream keeps reading; `max_pending` bounds how much data sits in memory.
+    def __init__(self, workers, max_pending=256 << 20):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.futures = {}
+        self.errors = []
+
+    def _reserve(self, size):
+        with self.cond:
+            while self.pending and self.pending + size > self.max_pending:
+                self.cond.wait()
+            self.pending += size
+
+    def _release(self, size):
+        with self.cond:
+            self.pending -= size
+            self.cond.notify_all()
+
+    def _write(self, path, data, mode, mtime):
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+        except OSError as e:
+            self.errors.append(e)
+        finally:
+            self._release(len(data))
+
+    def submit(self, path, data, mode, mtime):
+        self._reserve(len(data))
+        self.futures[path] = self.executor.submit(self._write, path, data, mode, mtime)
+
+    def wait_for(self, path):
+        future = self.futures.get(path)
+        if future is not None:
+            future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+class _OffsetReader:
+    # Reports how far the archive file behind `fd` has been read, also when a
+    # decompressor child shares the file and `raw` is its output
+    def __init__(self, raw, fd, progress):
+        self.raw = raw
+        self.fd = fd
+        self.progress = progress
+        self.offset = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        offset = os.lseek(self.fd, 0, os.SEEK_CUR)
+        if offset > self.offset:
+            self.progress(offset - self.offset)
+            self.offset = offset
+        return data
+
+class _CountingReader:
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.count += len(data)
+        return data
+
+def _extract_stream(fileobj, dst, workers, large_file=64 << 20, top_level=None):
+    writer = _ParallelWriter(workers)
+    guard = _LinkGuard(dst)
+    directories = []
+    files = 0
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                path = _safe_join(dst, member.name)
+                if top_level is not None and path != dst:
+                    top_level.add(os.path.relpath(path, dst).split(os.sep)[0])
+                guard.parent(path, member.name)
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    guard.resolved(path, member.name)
+                    directories.append((path, member))
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if os.path.islink(path) or (os.path.lexists(path) and not os.path.isdir(path)):
+                    writer.wait_for(path)
+                    os.unlink(path)
+                if member.issym():
+                    guard.symlink(path, member.linkname, member.name)
+                    os.symlink(member.linkname, path)
+                elif member.islnk():
+                    source = _safe_join(dst, member.linkname)
+                    guard.resolved(source, member.name)
+                    writer.wait_for(source)
+                    os.link(source, path)
+                elif member.isfile():
+                    source = tar.extractfile(member)
+                    if member.size > large_file:
+                        # Too big to buffer; stream it straight to disk from this thread
+                        with open(path, "wb") as f:
+                            shutil.copyfileobj(source, f, CHUNK_SIZE)
+                        os.chmod(path, member.mode)
+                        os.utime(path, (member.mtime, member.mtime))
+                    else:
+                        writer.submit(path, source.read(), member.mode, member.mtime)
+                else:
+                    continue
+                files += 1
+    finally:
+        writer.close()
+
+    # Directory modes last, the same way tar does it, so read-only dirs don't block their contents
+    for path, member in reversed(directories):
+        if os.path.islink(path):
+            continue
+        os.chmod(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
+    return files
+
+def stream_extract(url, dst, workers=8, headers=None, cache=None, mirrors=None, min_rate=0):
+    # HTTP body -> (lz4|zstd -dc) -> tar members -> parallel file writes, with no
+    # archive ever touching the disk unless `cache` keeps a copy for the next
+    # session. Returns (bytes received, files written).
+    dst = os.path.abspath(dst)
+    os.makedirs(dst, exist_ok=True)
+    received = 0
+    command = _decompressor(url)
+
+    with (cache.open(url, headers=headers, mirrors=mirrors, min_rate=min_rate) if cache
+          else open_mirrored(url, mirrors, headers, min_rate)) as response:
+        if command is None:
+            counter = _CountingReader(response)
+            files = _extract_stream(counter, dst, workers)
+            # Drain the tar padding after the end-of-archive marker
+            while counter.read(CHUNK_SIZE):
+                pass
+            return counter.count, files
+
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        feed_error = []
+
+        def feed():
+            nonlocal received
+            try:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    process.stdin.write(chunk)
+            except (OSError, ValueError) as e:
+                feed_error.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            files = _extract_stream(process.stdout, dst, workers)
+        finally:
+            process.stdout.close()
+            feeder.join()
+            returncode = process.wait()
+        if feed_error:
+            raise feed_error[0]
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+        return received, files
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar.lz4", ".tar.zst")
+
+def is_archive(name):
+    return bool(name) and name.lower().endswith(ARCHIVE_SUFFIXES)
+
+def extract_archive(path, dst, workers=8, progress=None):
+    # Extracts a downloaded .zip or tarball into dst and returns the names it
+    # created at the top level, so they can stand in for the archive later.
+    # `progress` is called with the archive bytes consumed as it goes.
+    dst = os.path.abspath(dst)
+    top_level = set()
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                _safe_join(dst, name)
+                if name.strip("/"):
+                    top_level.add(name.strip("/").split("/")[0])
+            for member in archive.infolist():
+                archive.extract(member, dst)
+                if progress:
+                    progress(member.compress_size)
+        return sorted(top_level)
+    command = _decompressor(path)
+    with open(path, "rb") as f:
+        if command is None:
+            _extract_stream(_OffsetReader(f, f.fileno(), progress) if progress else f, dst, workers, top_level=top_level)
+            return sorted(top_level)
+        process = subprocess.Popen(command, stdin=f, stdout=subprocess.PIPE)
+        try:
+            source = _OffsetReader(process.stdout, f.fileno(), progress) if progress else process.stdout
+            _extract_stream(source, dst, workers, top_level=top_level)
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+    return sorted(top_level)
@@ -3,6 +3,8 @@ import requests
 from colorama import init, Fore, Back, Style
 from colablib.colored_print import cprint, print_line
 from colablib.utils.tunnel import Tunnel
+from tunnel_race import TunnelRace
+from public_ip import PublicIPLookup
 import time
 import cloudpickle as pickle
 try:
@@ -10,14 +12,12 @@ try:
 except:
     start_colab = int(time.time())-5
     
-def get_public_ip(version='ipv4'):
-    try:
-        url = f'https://api64.ipify.org?format=json&{version}=true'
-        response = requests.get(url)
-        data = response.json()
-        public_ip = data['ip']
-        return public_ip
-    except Exception as e:
-        print(f"Error getting public {version} address:", e)
+public_ip_lookup = PublicIPLookup()
 
-public_ipv4 = get_public_ip(version='ipv4')
\ No newline at end of file
+def get_public_ip(timeout=None):
+    # IPv4 only: the lookup accepts nothing else, and it is what localtunnel asks for
+    return public_ip_lookup.get(timeout)
+
+# Kept for notebooks that still build the localtunnel note from it; a cache
+# hit is immediate, otherwise this waits at most a second.
+public_ipv4 = get_public_ip(timeout=1)
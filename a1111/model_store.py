@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import shutil
+import threading
+from colablib.colored_print import cprint
+from download_engine import strip_credentials
+
+# One row per kind of model: the category that holds it in each UI's download
+# list. Both UIs share the store, so a file fetched for one shows up in the other.
+CATEGORY_MAP = {
+    "checkpoint": {"a1111": "model", "cui": "checkpoints"},
+    "vae": {"a1111": "vae", "cui": "vae"},
+    "lora": {"a1111": "lora", "cui": "loras"},
+    "embedding": {"a1111": "embedding", "cui": "embeddings"},
+    "controlnet": {"cui": "controlnet"},
+    "hypernetwork": {"cui": "hypernetworks"},
+    "upscaler": {"cui": "upscale_models"},
+    "clip": {"cui": "clip"},
+    "unet": {"cui": "unet"},
+}
+SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+def kind_of(ui, category):
+    for kind, categories in CATEGORY_MAP.items():
+        if categories.get(ui) == category:
+            return kind
+    return None
+
+def etag_sha256(etag):
+    # Huggingface serves LFS files with their sha256 as the ETag
+    etag = (etag or "").strip('"').removeprefix("W/").strip('"')
+    return etag if SHA256.match(etag) else None
+
+def _link(source, target):
+    # A hardlink costs nothing and survives the store being moved; a symlink
+    # covers the store living on another filesystem
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    tmp = target + ".link"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        os.symlink(os.path.abspath(source), tmp)
+    os.replace(tmp, target)
+
+class ModelStore:
+    # Content-addressed blobs under root/blobs/<sha256>, plus an index of which
+    # URLs produced which blob and under what name and kind it was first stored.
+    def __init__(self, root, ui):
+        self.root = root
+        self.ui = ui
+        self.index_path = os.path.join(root, "index.json")
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        # Older runs recorded civitai URLs with the API key still in them
+        self.urls = {strip_credentials(url)[0]: sha256 for url, sha256 in index.get("urls", {}).items()}
+        self.blobs = index.get("blobs", {})
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, "blobs", sha256[:2], sha256)
+
+    def _save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"urls": self.urls, "blobs": self.blobs}, f, indent=1)
+        os.replace(tmp, self.index_path)
+
+    def lookup(self, job):
+        # The URL seen before, or an ETag that is the file's sha256 (huggingface LFS files)
+        sha256 = self.urls.get(job.url)
+        etag = etag_sha256(job.etag)
+        if sha256 is None and etag in self.blobs:
+            sha256 = etag
+        if sha256 is None or not os.path.isfile(self.blob_path(sha256)):
+            return None
+        return sha256
+
+    def link_into(self, sha256, path):
+        _link(self.blob_path(sha256), path)
+        return self.blobs[sha256]["size"]
+
+    def add(self, job, sha256):
+        # Called after a download; the file becomes a link to the blob, which
+        # is the downloaded file itself unless the store already had those bytes
+        kind = kind_of(self.ui, job.category)
+        if kind is None or not sha256:
+            return False
+        blob = self.blob_path(sha256)
+        with self.lock:
+            duplicate = os.path.isfile(blob)
+            if duplicate:
+                _link(blob, job.path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(job.path, blob)
+                except OSError:
+                    shutil.move(job.path, blob)
+                    os.symlink(os.path.abspath(blob), job.path)
+                self.blobs[sha256] = {"size": os.path.getsize(blob), "kind": kind, "name": job.filename}
+            self.urls[job.url] = sha256
+            self._save()
+        return duplicate
+
+    def populate(self, custom_dirs):
+        # Links every stored blob of a kind this UI has a folder for, under its
+        # original name, unless a file of that name is already there
+        linked = 0
+        for sha256, blob in self.blobs.items():
+            category = CATEGORY_MAP.get(blob["kind"], {}).get(self.ui)
+            if category not in custom_dirs or not os.path.isfile(self.blob_path(sha256)):
+                continue
+            target = os.path.join(custom_dirs[category].dst, blob["name"])
+            if os.path.lexists(target):
+                continue
+            self.link_into(sha256, target)
+            linked += 1
+        if linked:
+            cprint(f"[+] Linked {linked} files from the shared model store.", color="flat_green")
+        return linked
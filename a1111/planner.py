@@ -0,0 +1,194 @@
+import os
+import json
+import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from colablib.colored_print import cprint
+from fetch import open_url, is_archive, CHUNK_SIZE
+from persist import existing_parent, free_space, FREE_MARGIN
+
+SAMPLE_BYTES = 4 << 20
+# Model archives barely compress, so the extracted files take about as much again
+ARCHIVE_EXPANSION = 1.0
+
+def _format_size(size):
+    if size >= 1 << 30:
+        return f"{size / (1 << 30):.1f} GB"
+    return f"{size / (1 << 20):.1f} MB"
+
+def _format_time(seconds):
+    if seconds >= 3600:
+        return f"{seconds // 3600:.0f}h{seconds % 3600 // 60:02.0f}m"
+    if seconds >= 60:
+        return f"{seconds // 60:.0f}m{seconds % 60:02.0f}s"
+    return f"{seconds:.0f}s"
+
+def device_of(path):
+    # The destination folders are created by the download itself
+    return os.stat(existing_parent(path)).st_dev
+
+def job_name(job):
+    return job.filename or os.path.basename(urlparse(job.url).path)
+
+def space_needed(job, extract=False, stored=()):
+    # Bytes the job will add to its disk at its peak; unknown sizes count as 0
+    if job in stored or not job.size:
+        return 0
+    if extract and is_archive(job_name(job)):
+        return int(job.size * (1 + ARCHIVE_EXPANSION))
+    return job.size
+
+class DiskBudget:
+    # Admission control for DownloadEngine.run: a job may start when what it
+    # needs fits in the space free on its filesystem right now, less the margin
+    # and less what the jobs already running there may still write. Files in
+    # flight are preallocated sparse, so statvfs alone would not see them.
+    def __init__(self, needed):
+        self.needed = needed
+        self.reserved = {}
+        self.devices = {}
+
+    def _device(self, job):
+        if job.dst not in self.devices:
+            self.devices[job.dst] = device_of(job.dst)
+        return self.devices[job.dst]
+
+    def available(self, job):
+        return free_space(job.dst) - self.reserved.get(self._device(job), 0)
+
+    def fits(self, job):
+        needed = self.needed(job)
+        return not needed or needed <= self.available(job)
+
+    def reserve(self, job):
+        device = self._device(job)
+        self.reserved[device] = self.reserved.get(device, 0) + self.needed(job)
+
+    def release(self, job):
+        device = self._device(job)
+        self.reserved[device] -= self.needed(job)
+
+    def shortfall(self, job):
+        return (f"Not enough disk space for {job_name(job)}: it needs {_format_size(self.needed(job))}, "
+                f"{_format_size(max(self.available(job), 0))} is free on {existing_parent(job.dst)} "
+                f"after keeping {_format_size(FREE_MARGIN)} spare")
+
+class ThroughputHistory:
+    # Bytes per second each host delivered on earlier runs, all of its jobs together
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.rates = json.load(f)
+        except (OSError, ValueError):
+            self.rates = {}
+
+    def get(self, host):
+        return self.rates.get(host)
+
+    def update(self, results):
+        spans = {}
+        for result in results:
+            if result.success and result.size:
+                size, start, end = spans.get(result.job.host, (0, result.start, result.end))
+                spans[result.job.host] = (size + result.size, min(start, result.start), max(end, result.end))
+        for host, (size, start, end) in spans.items():
+            # Tiny files say more about latency than about bandwidth
+            if size < SAMPLE_BYTES or end <= start:
+                continue
+            rate = size / (end - start)
+            old = self.rates.get(host)
+            self.rates[host] = rate if old is None else (old + rate) / 2
+
+    def save(self):
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.rates, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+def sample_rate(job, timeout=10):
+    # Times the first SAMPLE_BYTES of the job from the first byte on, one connection
+    try:
+        with open_url(job.url, headers={**(job.auth or {}), "Range": f"bytes=0-{SAMPLE_BYTES - 1}"}, timeout=timeout) as response:
+            start = time.time()
+            received = 0
+            while received < SAMPLE_BYTES:
+                chunk = response.read(min(CHUNK_SIZE, SAMPLE_BYTES - received))
+                if not chunk:
+                    break
+                received += len(chunk)
+            elapsed = time.time() - start
+    except (OSError, ValueError):
+        return None
+    return received / elapsed if received and elapsed > 0 else None
+
+def measure_rates(jobs, history, workers=8):
+    # host -> (bytes per second, where the number comes from); hosts without
+    # history are sampled concurrently with a short range request on their largest file
+    rates = {}
+    samples = {}
+    for job in sorted(jobs, key=lambda job: job.size or 0, reverse=True):
+        if job.host in rates or job.host in samples:
+            continue
+        if history.get(job.host):
+            rates[job.host] = (history.get(job.host), "last runs")
+        elif (job.size or 0) >= SAMPLE_BYTES and urlparse(job.url).scheme in ("http", "https"):
+            samples[job.host] = job
+    if samples:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for host, rate in zip(samples, executor.map(sample_rate, samples.values())):
+                if rate:
+                    rates[host] = (rate, "sampled")
+    return rates
+
+class DownloadPlan:
+    # What a run is about to fetch: the bytes bound for each filesystem against
+    # the space free there, and the time per host at the rates measured for it.
+    def __init__(self, jobs, needed, rates):
+        self.jobs = jobs
+        self.unknown = [job for job in jobs if job.size is None and job.category != "extensions" and not job.url.startswith("fuse:")]
+        self.disks = {}
+        self.hosts = {}
+        for job in jobs:
+            disk = self.disks.setdefault(device_of(job.dst), {"path": existing_parent(job.dst), "needed": 0, "files": 0})
+            disk["needed"] += needed(job)
+            disk["files"] += 1
+            if needed(job):
+                host = self.hosts.setdefault(job.host, {"bytes": 0, "files": 0})
+                host["bytes"] += job.size
+                host["files"] += 1
+        for disk in self.disks.values():
+            disk["free"] = free_space(disk["path"])
+        for host, info in self.hosts.items():
+            info["rate"], info["source"] = rates.get(host, (None, None))
+        self.fits = all(disk["needed"] <= disk["free"] for disk in self.disks.values())
+
+    @property
+    def seconds(self):
+        # Hosts download side by side, so the slowest one sets the pace
+        times = [info["bytes"] / info["rate"] for info in self.hosts.values() if info["rate"]]
+        return max(times, default=0)
+
+    def print(self):
+        cprint(f"[+] Plan: {len(self.jobs)} downloads, {len(self.unknown)} of unknown size.", color="flat_cyan")
+        for disk in self.disks.values():
+            spare = disk["free"] - disk["needed"]
+            cprint(f"    {disk['path']}: {disk['files']} files, {_format_size(disk['needed'])} needed, "
+                   f"{_format_size(disk['free'])} free" + ("" if spare >= 0 else f", {_format_size(-spare)} short"),
+                   color="flat_green" if spare >= 0 else "flat_red")
+        for host, info in sorted(self.hosts.items(), key=lambda item: item[1]["bytes"], reverse=True):
+            if info["rate"]:
+                estimate = f"{info['rate'] / (1 << 20):.1f} MB/s ({info['source']}), about {_format_time(info['bytes'] / info['rate'])}"
+            else:
+                estimate = "speed unknown"
+            cprint(f"    {host}: {info['files']} files, {_format_size(info['bytes'])}, {estimate}", color="flat_cyan")
+        for job in self.unknown:
+            cprint(f"    size unknown: {job.category}: {job_name(job)}", color="flat_yellow")
+        if self.seconds:
+            cprint(f"[+] Estimated download time: {_format_time(self.seconds)}.", color="flat_cyan")
+        if not self.fits:
+            cprint("Warning: the list does not fit on disk; downloads start only while there is room for them "
+                   "and the rest will fail.", color="flat_yellow")
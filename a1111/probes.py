@@ -0,0 +1,73 @@
+import os
+import shutil
+import subprocess
+import importlib.metadata
+
+DPKG_STATUS = "/var/lib/dpkg/status"
+
+def on_path(command):
+    return shutil.which(command) is not None
+
+def is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+def binary_version(path, args, version, timeout=5):
+    # True when `path args...` runs and mentions `version` anywhere in its output
+    if not is_executable(path):
+        return False
+    try:
+        result = subprocess.run([path, *args], capture_output=True, text=True, timeout=timeout)
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return version in result.stdout + result.stderr
+
+def dpkg_installed(package, status_path=DPKG_STATUS):
+    try:
+        with open(status_path, encoding="utf-8", errors="replace") as f:
+            paragraphs = f.read().split("\n\n")
+    except OSError:
+        return False
+    for paragraph in paragraphs:
+        fields = dict(line.split(": ", 1) for line in paragraph.splitlines() if ": " in line and not line.startswith(" "))
+        if fields.get("Package") == package:
+            return fields.get("Status", "").endswith(" installed")
+    return False
+
+def apt_installed(package, command=None):
+    # The command on PATH is what the steps need, wherever it came from
+    return on_path(command) if command else dpkg_installed(package)
+
+def pip_installed(package):
+    try:
+        importlib.metadata.version(package)
+        return True
+    except importlib.metadata.PackageNotFoundError:
+        return False
+
+def _git(path, *args, timeout=15):
+    result = subprocess.run(["git", "-C", path, *args], capture_output=True, text=True, timeout=timeout)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def git_head(path):
+    if not os.path.isdir(os.path.join(path, ".git")):
+        return None
+    try:
+        return _git(path, "rev-parse", "HEAD")
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def git_at_remote(path, branch, remote="origin"):
+    # Checked out on `branch`, no local changes and at the commit the remote
+    # has for it; one ls-remote round trip instead of a full fetch
+    head = git_head(path)
+    if head is None:
+        return False
+    try:
+        if _git(path, "symbolic-ref", "--short", "HEAD") != branch:
+            return False
+        if subprocess.run(["git", "-C", path, "diff", "--quiet", "HEAD"], capture_output=True, timeout=60).returncode != 0:
+            return False
+        remote_head = _git(path, "ls-remote", remote, f"refs/heads/{branch}")
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return bool(remote_head) and remote_head.split()[0] == head
@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import queue
+import ipaddress
+import threading
+import urllib.request
+
+IP_PROVIDERS = [
+    "https://api.ipify.org?format=json",
+    "https://checkip.amazonaws.com",
+    "https://icanhazip.com",
+    "https://ifconfig.me/ip",
+    "https://ipinfo.io/ip",
+]
+IP_CACHE_PATH = os.path.expanduser("~/.cache/sd-webui-notebook/public_ip.json")
+IP_CACHE_TTL = 3600
+
+def _parse_ip(text):
+    text = text.strip()
+    if text.startswith("{"):
+        text = json.loads(text)["ip"]
+    return str(ipaddress.IPv4Address(text))
+
+def _fetch_ip(url, timeout):
+    request = urllib.request.Request(url, headers={"User-Agent": "sd-webui-notebook"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return _parse_ip(response.read(256).decode("ascii", "replace"))
+
+def race_public_ip(providers=IP_PROVIDERS, timeout=3):
+    # Every provider is asked at once; the first valid IPv4 answer wins and
+    # the stragglers are left to time out on their own daemon threads.
+    answers = queue.Queue()
+
+    def ask(url):
+        try:
+            answers.put(_fetch_ip(url, timeout))
+        except (OSError, ValueError, KeyError):
+            answers.put(None)
+
+    for url in providers:
+        threading.Thread(target=ask, args=(url,), daemon=True).start()
+    for _ in providers:
+        ip = answers.get()
+        if ip:
+            return ip
+    return None
+
+def _read_cache(path, ttl):
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+        if time.time() - entry["time"] < ttl:
+            return entry["ip"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def _write_cache(path, ip):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"ip": ip, "time": time.time()}, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+class PublicIPLookup:
+    # Starts the lookup on a background thread right away; get() waits at
+    # most `timeout` seconds and returns "" if no answer has arrived by then.
+    def __init__(self, providers=IP_PROVIDERS, timeout=3, cache_path=IP_CACHE_PATH, ttl=IP_CACHE_TTL):
+        self.providers = providers
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self.ip = _read_cache(cache_path, ttl) if cache_path else None
+        self.done = threading.Event()
+        if self.ip:
+            self.done.set()
+        else:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        self.ip = race_public_ip(self.providers, self.timeout)
+        if self.ip and self.cache_path:
+            _write_cache(self.cache_path, self.ip)
+        self.done.set()
+
+    def get(self, timeout=None):
+        self.done.wait(timeout)
+        return self.ip or ""
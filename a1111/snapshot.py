@@ -0,0 +1,399 @@
+import os
+import json
+import time
+import errno
+import uuid
+import zlib
+import queue
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from colablib.colored_print import cprint
+from persist import room
+
+CHUNK_SIZE = 16 << 20  # files are stored as chunks of this size, so one checkpoint restores on every worker
+PACK_SIZE = 256 << 20
+RESTORE_RUN = 64 << 20
+COMPRESS_LEVEL = 1
+TRIAL_SIZE = 64 << 10
+INCOMPRESSIBLE = 0.9  # models and archives are stored as they are
+SKIP_SUFFIXES = (".part", ".part.json", ".tmp", ".restore")
+
+@dataclass
+class SnapshotRoot:
+    name: str
+    path: str
+    names: list = None  # only these top-level entries of path
+    exclude: list = field(default_factory=list)  # top-level entries of path left out
+    provides: list = field(default_factory=list)  # step outputs a full restore stands in for
+
+def _scan(root, inodes):
+    # rel -> entry, parents before children:
+    #   ["d", mode, mtime_ns]  ["l", target]  ["f", mode, mtime_ns, size, chunks]
+    #   ["h", root name, rel]  for a file already seen under another name (the model store's hardlinks)
+    entries = {}
+
+    def walk(directory, rel):
+        try:
+            with os.scandir(directory) as it:
+                items = sorted(it, key=lambda item: item.name)
+        except OSError:
+            return
+        for item in items:
+            if not rel and ((root.names is not None and item.name not in root.names) or item.name in root.exclude):
+                continue
+            if item.name.endswith(SKIP_SUFFIXES):
+                continue
+            path = os.path.join(rel, item.name) if rel else item.name
+            try:
+                stat = item.stat(follow_symlinks=False)
+                if item.is_symlink():
+                    entries[path] = ["l", os.readlink(item.path)]
+                elif item.is_dir(follow_symlinks=False):
+                    entries[path] = ["d", stat.st_mode & 0o7777, stat.st_mtime_ns]
+                    walk(item.path, path)
+                elif item.is_file(follow_symlinks=False):
+                    key = (stat.st_dev, stat.st_ino)
+                    if stat.st_nlink > 1 and key in inodes:
+                        entries[path] = ["h", *inodes[key]]
+                        continue
+                    inodes[key] = (root.name, path)
+                    entries[path] = ["f", stat.st_mode & 0o7777, stat.st_mtime_ns, stat.st_size, None]
+            except OSError:
+                continue
+
+    walk(root.path, "")
+    return entries
+
+def _compress(data):
+    # A cheap trial on the first 64 KB decides; compressing a whole checkpoint
+    # only to throw the result away would cost more than storing it
+    if len(zlib.compress(data[:TRIAL_SIZE], COMPRESS_LEVEL)) >= min(len(data), TRIAL_SIZE) * INCOMPRESSIBLE:
+        return data, False
+    packed = zlib.compress(data, COMPRESS_LEVEL)
+    return (packed, True) if len(packed) < len(data) * INCOMPRESSIBLE else (data, False)
+
+def _close_pack(pack):
+    # The index written after this must never point past what reached the disk
+    try:
+        pack.flush()
+        os.fsync(pack.fileno())
+    finally:
+        pack.close()
+
+def _format_size(size):
+    return f"{size / (1 << 30):.2f} GB" if size >= 1 << 30 else f"{size / (1 << 20):.1f} MB"
+
+class SnapshotStore:
+    # Content-addressed chunks in append-only pack files, objects.json mapping
+    # each sha256 to (pack, offset, length, compressed), and one manifest per
+    # snapshot under snapshots/. A snapshot only hashes files whose size or
+    # mtime changed since the previous one and only writes chunks not stored yet.
+    # A snapshot that would not fit the free space, or `budget` bytes together
+    # with the `shared` directories, is skipped with a warning.
+    def __init__(self, path, budget=None, shared=()):
+        self.path = path
+        self.budget = budget
+        self.shared = shared
+        self.packs_dir = os.path.join(path, "packs")
+        self.snapshots_dir = os.path.join(path, "snapshots")
+        self.index_path = os.path.join(path, "objects.json")
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path) as f:
+                self.objects = json.load(f)
+        except (OSError, ValueError):
+            self.objects = {}
+
+    def _write_json(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    def snapshots(self):
+        try:
+            return sorted(name for name in os.listdir(self.snapshots_dir) if name.endswith(".json"))
+        except OSError:
+            return []
+
+    def latest(self):
+        for name in reversed(self.snapshots()):
+            try:
+                with open(os.path.join(self.snapshots_dir, name)) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def _store(self, files, workers):
+        # files: [(entry, path)]; fills entry[4] with chunk hashes. Every worker
+        # appends to a pack of its own, so no two threads share a file handle.
+        work = queue.Queue()
+        for entry, path in files:
+            entry[4] = [None] * max(1, -(-entry[3] // CHUNK_SIZE))
+            for index in range(len(entry[4])):
+                work.put((entry, index, path))
+        claimed = set()
+        failed = set()
+        written = [0]
+        full = threading.Event()
+
+        def worker():
+            pack, name = None, None
+            try:
+                while not full.is_set():
+                    try:
+                        entry, index, path = work.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        with open(path, "rb") as f:
+                            data = os.pread(f.fileno(), CHUNK_SIZE, index * CHUNK_SIZE)
+                    except OSError:
+                        failed.add(id(entry))
+                        continue
+                    sha = hashlib.sha256(data).hexdigest()
+                    entry[4][index] = sha
+                    with self.lock:
+                        if sha in self.objects or sha in claimed:
+                            continue
+                        claimed.add(sha)
+                    blob, compressed = _compress(data)
+                    try:
+                        if pack is None or pack.tell() >= PACK_SIZE:
+                            if pack:
+                                pack, closing = None, pack
+                                _close_pack(closing)
+                            name = f"{uuid.uuid4().hex}.pack"
+                            pack = open(os.path.join(self.packs_dir, name), "wb")
+                        offset = pack.tell()
+                        pack.write(blob)
+                    except OSError as e:
+                        if e.errno != errno.ENOSPC:
+                            raise
+                        full.set()
+                        return
+                    with self.lock:
+                        self.objects[sha] = [name, offset, len(blob), int(compressed)]
+                        written[0] += len(blob)
+            finally:
+                if pack:
+                    try:
+                        _close_pack(pack)
+                    except OSError as e:
+                        if e.errno != errno.ENOSPC:
+                            raise
+                        full.set()
+
+        os.makedirs(self.packs_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(worker) for _ in range(workers)]:
+                future.result()
+        return written[0], failed, full.is_set()
+
+    def save(self, roots, workers=8, keep=2):
+        start_time = time.time()
+        previous = self.latest() or {"roots": {}}
+        manifest = {"created": time.time(), "roots": {}}
+        inodes = {}
+        changed = []
+        total = 0
+        for root in roots:
+            entries = _scan(root, inodes)
+            before = previous["roots"].get(root.name, {}).get("entries", {})
+            for rel, entry in entries.items():
+                if entry[0] != "f":
+                    continue
+                total += entry[3]
+                old = before.get(rel)
+                if old and old[0] == "f" and old[2:4] == entry[2:4] and all(sha in self.objects for sha in old[4]):
+                    entry[4] = old[4]
+                else:
+                    changed.append((entry, os.path.join(root.path, rel)))
+            manifest["roots"][root.name] = {"path": root.path, "entries": entries}
+
+        # Every changed file counted in full: compression and chunks already stored only make it smaller
+        needed = sum(entry[3] for entry, _ in changed)
+        available = room(self.path, self.budget, self.shared)
+        if needed > available:
+            cprint(f"Warning: snapshot skipped, its {len(changed)} changed files need up to {_format_size(needed)} "
+                   f"and only {_format_size(available)} is left for it.", color="flat_yellow")
+            return 0
+        written, failed, full = self._store(changed, workers)
+        if full:
+            # Nothing refers to the chunks written so far, so pruning takes them back out
+            self.prune(keep)
+            cprint("Warning: snapshot skipped, the disk filled up while it was written.", color="flat_yellow")
+            return 0
+        if failed:
+            # Files that vanished while the snapshot was taken are left out of it
+            for saved in manifest["roots"].values():
+                saved["entries"] = {rel: entry for rel, entry in saved["entries"].items() if id(entry) not in failed}
+        self._write_json(self.index_path, self.objects)
+        self._write_json(os.path.join(self.snapshots_dir, f"{time.time_ns()}.json"), manifest)
+        self.prune(keep)
+        cprint(f"[+] Snapshot of {_format_size(total)}: {len(changed)} changed files, {_format_size(written)} written "
+               f"in {time.time() - start_time:.2f} secs.", color="flat_green")
+        return written
+
+    def prune(self, keep=2):
+        # Drops all but the newest `keep` snapshots, then every object and pack nothing refers to
+        names = self.snapshots()
+        for name in names[:-keep]:
+            os.remove(os.path.join(self.snapshots_dir, name))
+        referenced = set()
+        for name in names[-keep:]:
+            with open(os.path.join(self.snapshots_dir, name)) as f:
+                for saved in json.load(f)["roots"].values():
+                    for entry in saved["entries"].values():
+                        if entry[0] == "f":
+                            referenced.update(entry[4])
+        self.objects = {sha: location for sha, location in self.objects.items() if sha in referenced}
+        used = {location[0] for location in self.objects.values()}
+        for name in os.listdir(self.packs_dir) if os.path.isdir(self.packs_dir) else []:
+            if name not in used:
+                os.remove(os.path.join(self.packs_dir, name))
+        self._write_json(self.index_path, self.objects)
+
+    def restore(self, roots, workers=8):
+        # Rebuilds the roots from the newest snapshot. Files whose size and mtime
+        # already match are left alone; the rest are written chunk by chunk,
+        # grouped into sequential runs of each pack that the workers take in parallel.
+        # Returns what the fully restored roots provide.
+        start_time = time.time()
+        manifest = self.latest()
+        if manifest is None:
+            return set()
+        packs = {}
+        targets = {}  # sha -> [(tmp path, offset)]
+        finals = []
+        links = []
+        directories = []
+        complete = {}
+        skipped = 0
+
+        def have(sha):
+            location = self.objects.get(sha)
+            if location is None:
+                return False
+            if location[0] not in packs:
+                packs[location[0]] = os.path.exists(os.path.join(self.packs_dir, location[0]))
+            return packs[location[0]]
+
+        for root in roots:
+            saved = manifest["roots"].get(root.name)
+            if not saved or not saved["entries"]:
+                continue
+            # A root limited to some names stands in for its steps only if all of them were saved
+            complete[root.name] = not root.names or set(root.names) <= saved["entries"].keys()
+            for rel, entry in saved["entries"].items():
+                path = os.path.join(root.path, rel)
+                if entry[0] == "d":
+                    os.makedirs(path, exist_ok=True)
+                    directories.append((path, entry))
+                elif entry[0] == "l":
+                    if not os.path.lexists(path):
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        os.symlink(entry[1], path)
+                elif entry[0] == "h":
+                    source_root = manifest["roots"][entry[1]]["path"]
+                    links.append((root.name, os.path.join(source_root, entry[2]), path))
+                else:
+                    _, mode, mtime, size, chunks = entry
+                    try:
+                        stat = os.stat(path, follow_symlinks=False)
+                        if stat.st_size == size and stat.st_mtime_ns == mtime:
+                            skipped += 1
+                            continue
+                    except OSError:
+                        pass
+                    if not all(have(sha) for sha in chunks):
+                        complete[root.name] = False
+                        continue
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp = path + ".restore"
+                    with open(tmp, "wb") as f:
+                        f.truncate(size)
+                    for index, sha in enumerate(chunks):
+                        targets.setdefault(sha, []).append((tmp, index * CHUNK_SIZE))
+                    finals.append((root.name, tmp, path, mode, mtime, size, chunks))
+
+        runs = []
+        by_pack = {}
+        for sha in targets:
+            name, offset, length, compressed = self.objects[sha]
+            by_pack.setdefault(name, []).append((offset, length, compressed, sha))
+        for name, blobs in by_pack.items():
+            blobs.sort()
+            run, run_size = [], 0
+            for blob in blobs:
+                run.append(blob)
+                run_size += blob[1]
+                if run_size >= RESTORE_RUN:
+                    runs.append((name, run))
+                    run, run_size = [], 0
+            if run:
+                runs.append((name, run))
+
+        bad = set()
+
+        def restore_run(item):
+            name, blobs = item
+            with open(os.path.join(self.packs_dir, name), "rb") as pack:
+                for offset, length, compressed, sha in blobs:
+                    try:
+                        data = os.pread(pack.fileno(), length, offset)
+                        if compressed:
+                            data = zlib.decompress(data)
+                        if hashlib.sha256(data).hexdigest() != sha:
+                            raise ValueError("checksum mismatch")
+                    except (OSError, ValueError, zlib.error):
+                        bad.add(sha)
+                        continue
+                    for tmp, at in targets[sha]:
+                        fd = os.open(tmp, os.O_WRONLY)
+                        try:
+                            os.pwrite(fd, data, at)
+                        finally:
+                            os.close(fd)
+
+        # Largest runs first so a lone checkpoint does not start last
+        runs.sort(key=lambda run: sum(blob[1] for blob in run[1]), reverse=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(restore_run, runs))
+
+        restored = 0
+        for name, tmp, path, mode, mtime, size, chunks in finals:
+            if bad.intersection(chunks):
+                os.remove(tmp)
+                complete[name] = False
+                continue
+            os.chmod(tmp, mode)
+            os.utime(tmp, ns=(mtime, mtime))
+            os.replace(tmp, path)
+            restored += size
+        for name, source, path in links:
+            if os.path.exists(path) and os.path.samefile(source, path):
+                continue
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.link(source, path + ".restore")
+                os.replace(path + ".restore", path)
+            except OSError:
+                complete[name] = False
+        for path, entry in reversed(directories):
+            os.chmod(path, entry[1])
+            os.utime(path, ns=(entry[2], entry[2]))
+        if bad:
+            cprint(f"Warning: {len(bad)} damaged chunks in the snapshot, those files were not restored.", color="flat_yellow")
+
+        # An output several roots provide together (the UI tree and its venv) needs all of them restored
+        provided = {item for root in roots for item in root.provides}
+        provided -= {item for root in roots if not complete.get(root.name) for item in root.provides}
+        cprint(f"[+] Restored {len(finals)} files ({_format_size(restored)}) from the snapshot of "
+               f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(manifest['created']))} in {time.time() - start_time:.2f} secs, "
+               f"{skipped} already in place.", color="flat_green")
+        return provided
@@ -0,0 +1,239 @@
+import os
+import time
+import shlex
+import shutil
+import signal
+import secrets
+import threading
+import subprocess
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from colablib.colored_print import cprint
+
+PROBE_PATH = "/__tunnel_probe"
+# loca.lt answers browsers with a reminder page unless this header is set
+PROBE_HEADERS = {"User-Agent": "sd-webui-notebook", "Bypass-Tunnel-Reminder": "1"}
+
+class _ProbeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path != f"{PROBE_PATH}/{self.server.token}":
+            self.send_error(404)
+            return
+        size = int(dict(item.partition("=")[::2] for item in query.split("&") if item).get("bytes", 0))
+        body = (self.server.token.encode() * (size // len(self.server.token) + 1))[:size]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+class ProbeServer:
+    # Answers on the tunnelled port until the WebUI takes it over, so every
+    # tunnel can be measured end to end before anything is launched.
+    def __init__(self, port, host="127.0.0.1"):
+        self.port = port
+        self.host = host
+        self.token = secrets.token_hex(8)
+        self.httpd = None
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), _ProbeHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.token = self.token
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+class RacedTunnel:
+    # `url` is for tunnels whose address comes from their config (frpc): the
+    # pattern then only has to match the line saying the tunnel is up
+    def __init__(self, command, name, pattern, note=None, url=None):
+        self.command = command
+        self.name = name
+        self.pattern = pattern
+        self.note = note
+        self.fixed_url = url
+        self.process = None
+        self.url = None
+        self.time_to_url = None
+        self.latency = None
+        self.throughput = None
+        self.error = None
+        self.found = threading.Event()
+
+    @property
+    def score(self):
+        # Time to load a small page: one round trip plus 1 MB of transfer
+        if self.latency is None or not self.throughput:
+            return float("inf")
+        return self.latency + (1 << 20) / self.throughput
+
+    def start(self, port):
+        started = time.time()
+        self.process = subprocess.Popen(self.command.format(port=port), shell=True, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, start_new_session=True)
+
+        def read():
+            # Keeps draining after the URL shows up so a chatty tunnel never blocks on a full pipe
+            for raw in iter(self.process.stdout.readline, b""):
+                if self.url is None:
+                    match = self.pattern.search(raw.decode("utf-8", "replace"))
+                    if match:
+                        url = (self.fixed_url or match.group(0)).rstrip("/")
+                        self.url = url if "://" in url else f"https://{url}"
+                        self.time_to_url = time.time() - started
+                        self.found.set()
+            self.process.wait()
+            self.found.set()
+
+        threading.Thread(target=read, daemon=True).start()
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        except ProcessLookupError:
+            pass
+
+def _get(url, timeout):
+    request = urllib.request.Request(url, headers=PROBE_HEADERS)
+    start = time.time()
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = response.read()
+    return body, time.time() - start
+
+class TunnelRace:
+    # Same add_tunnel() interface as colablib's Tunnel, but every tunnel is
+    # started at once, measured through a probe server on the local port,
+    # ranked, and all but the `keep` fastest are stopped (keep=0 keeps all).
+    # A probe request that fails is retried `retries` times, `backoff` seconds
+    # apart and doubling, before the tunnel counts as failed.
+    def __init__(self, port, keep=1, url_timeout=30, probe_bytes=256 << 10, pings=3, probe_timeout=15, retries=3, backoff=0.5):
+        self.port = port
+        self.keep = keep
+        self.url_timeout = url_timeout
+        self.probe_bytes = probe_bytes
+        self.pings = pings
+        self.probe_timeout = probe_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.tunnels = []
+
+    def add_tunnel(self, command, name, pattern, note=None, url=None):
+        # A tunnel whose program is not installed could only hold the race up until url_timeout
+        program = shlex.split(command)[0]
+        if shutil.which(program) is None:
+            cprint(f"[-] {name}: {program} is not installed, left out of the race.", color="flat_yellow")
+            return
+        self.tunnels.append(RacedTunnel(command, name, pattern, note, url))
+
+    def _get(self, url, check, size):
+        # A tunnel that just came up often drops its first requests while its edge connects
+        for attempt in range(self.retries + 1):
+            try:
+                body, elapsed = _get(url, self.probe_timeout)
+                if not check(body, size):
+                    raise ValueError("unexpected response")
+                return body, elapsed
+            except (OSError, ValueError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _probe(self, tunnel, server):
+        if server:
+            base = f"{tunnel.url}{PROBE_PATH}/{server.token}"
+            check = lambda body, size: len(body) == size and body.startswith(server.token.encode()[:size])
+        else:
+            # The port is already taken (WebUI running): measure its front page instead
+            base, check = tunnel.url, lambda body, size: True
+        try:
+            times = [self._get(f"{base}?bytes=0", check, 0)[1] for _ in range(self.pings)]
+            tunnel.latency = sorted(times)[len(times) // 2]
+            body, elapsed = self._get(f"{base}?bytes={self.probe_bytes}", check, self.probe_bytes)
+            tunnel.throughput = len(body) / max(elapsed - tunnel.latency, 1e-3)
+        except (OSError, ValueError) as e:
+            tunnel.error = str(e)
+
+    def race(self):
+        server = None
+        try:
+            server = ProbeServer(self.port).start()
+        except OSError:
+            cprint(f"[-] Port {self.port} is in use, probing the running service instead.", color="flat_yellow")
+        try:
+            for tunnel in self.tunnels:
+                tunnel.start(self.port)
+            deadline = time.time() + self.url_timeout
+
+            def measure(tunnel):
+                tunnel.found.wait(max(deadline - time.time(), 0))
+                if tunnel.url is None:
+                    tunnel.error = "no URL" if tunnel.process.poll() is None else f"exited with {tunnel.process.returncode}"
+                    return
+                self._probe(tunnel, server)
+
+            threads = [threading.Thread(target=measure, args=(tunnel,), daemon=True) for tunnel in self.tunnels]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if server:
+                server.stop()
+
+        self.tunnels.sort(key=lambda tunnel: tunnel.score)
+        kept = [tunnel for tunnel in self.tunnels if tunnel.error is None]
+        if not kept:
+            # Nothing could be measured (no outbound access from here?): keep every tunnel that has a URL
+            cprint("[-] No tunnel answered the probe, keeping all of them.", color="flat_yellow")
+            kept = [tunnel for tunnel in self.tunnels if tunnel.url]
+        elif self.keep:
+            kept = kept[:self.keep]
+        for tunnel in self.tunnels:
+            if tunnel not in kept:
+                tunnel.stop()
+        self.print_ranking(kept)
+        return kept
+
+    def print_ranking(self, kept):
+        cprint(f"    {'tunnel':<8} {'url s':>6} {'rtt ms':>7} {'MB/s':>6}  status", color="flat_cyan")
+        for tunnel in self.tunnels:
+            url_time = f"{tunnel.time_to_url:.1f}" if tunnel.time_to_url is not None else "-"
+            latency = f"{tunnel.latency * 1000:.0f}" if tunnel.latency is not None else "-"
+            throughput = f"{tunnel.throughput / (1 << 20):.1f}" if tunnel.throughput else "-"
+            status = "kept" if tunnel in kept else f"stopped ({tunnel.error})" if tunnel.error else "stopped"
+            cprint(f"    {tunnel.name:<8} {url_time:>6} {latency:>7} {throughput:>6}  {status}",
+                   color="flat_green" if tunnel in kept else "flat_red")
+        for tunnel in kept:
+            # A callable note is only evaluated here, e.g. a password that is still being looked up
+            note = tunnel.note() if callable(tunnel.note) else tunnel.note
+            cprint(f"[+] {tunnel.name}: {tunnel.url}" + (f"  {note}" if note else ""), color="flat_green")
+
+    def stop(self):
+        for tunnel in self.tunnels:
+            tunnel.stop()
+
+    def __enter__(self):
+        self.race()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import threading
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from local_server import LocalServer, make_bare_repo, push_commit
+
+SCENARIOS = ["ui_stream", "resource_steps", "resource_steps_cached", "custom_download", "custom_download_rerun", "tunnel_race", "public_ip",
+             "segmented_download", "aria2_download", "download_plan", "snapshot_restore", "mirror_failover", "ui_update"]
+THRESHOLDS = {"wall": 1.25, "peak_rss": 1.5, "peak_disk": 1.25}
+# Every scenario starts from an empty directory of its own, except these,
+# which measure a second run over what the first one left behind
+FOLLOWS = {"resource_steps_cached": "resource_steps", "custom_download_rerun": "custom_download"}
+# The download list's model categories in each UI (model_store.CATEGORY_MAP)
+MODEL_CATEGORIES = {"a1111": ("model", "lora"), "cui": ("checkpoints", "loras")}
+
+def _random_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        while size > 0:
+            chunk = os.urandom(min(size, 1 << 20))
+            f.write(chunk)
+            size -= len(chunk)
+
+def _tar_gz(path, members):
+    with tarfile.open(path, "w:gz") as tar:
+        for name, source in members.items():
+            tar.add(source, arcname=name)
+
+def build_fixtures(workdir, args):
+    serve = os.path.join(workdir, "serve")
+    repos = os.path.join(workdir, "repos")
+    os.makedirs(serve, exist_ok=True)
+    os.makedirs(repos, exist_ok=True)
+
+    # UI snapshot: a git checkout of a local bare repo plus a venv-like pile of small files and one big file
+    ui_bare, _ = make_bare_repo(os.path.join(repos, "ui.git"), files=50)
+    snapshot = os.path.join(workdir, "snapshot")
+    subprocess.run(["git", "clone", "-q", ui_bare, snapshot], check=True)
+    for index in range(args.small_files):
+        path = os.path.join(snapshot, "venv", "lib", f"pkg{index % 50}", f"mod{index}.py")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("VALUE = %d\n" % index * 20)
+    _random_file(os.path.join(snapshot, "venv", "lib", "libtorch.so"), args.ui_mb << 20)
+    archive = os.path.join(serve, "ui.tar.lz4")
+    subprocess.run(f"tar -cf - -C {snapshot} . | lz4 -q -1 > {archive}", shell=True, check=True)
+    shutil.rmtree(snapshot)
+
+    # Tool binaries laid out like the real release archives
+    tools = os.path.join(workdir, "tools")
+    _random_file(os.path.join(serve, "cloudflared-linux-amd64"), 8 << 20)
+    _random_file(os.path.join(tools, "frpc"), 4 << 20)
+    _random_file(os.path.join(tools, "zrok"), 4 << 20)
+    _tar_gz(os.path.join(serve, "frp_0.58.1_linux_amd64.tar.gz"), {"frp_0.58.1_linux_amd64/frpc": os.path.join(tools, "frpc")})
+    _tar_gz(os.path.join(serve, "zrok_0.4.23_linux_amd64.tar.gz"), {"zrok": os.path.join(tools, "zrok")})
+
+    # One large file for the downloader comparison
+    _random_file(os.path.join(serve, "download.bin"), args.download_mb << 20)
+
+    # Stand-in public IP providers for get_ip.py
+    os.makedirs(os.path.join(serve, "ip"))
+    for name, answer in {"fast": '{"ip": "203.0.113.7"}', "slow": "198.51.100.1\n", "garbage": "<html></html>"}.items():
+        with open(os.path.join(serve, "ip", name), "w") as f:
+            f.write(answer)
+
+    # Models and extensions for pastebin.py
+    for index in range(args.models):
+        _random_file(os.path.join(serve, "models", f"model{index}.safetensors"), (args.model_mb << 20) // (index + 1))
+    for index in range(args.extensions):
+        make_bare_repo(os.path.join(repos, f"extension{index}.git"))
+
+def write_download_list(workdir, base_url, args):
+    checkpoints, loras = MODEL_CATEGORIES[args.ui]
+    lines = [f"#{checkpoints}"]
+    lines += [f"{base_url}/models/model{index}.safetensors|model{index}.safetensors" for index in range(0, args.models, 2)]
+    lines += [f"#{loras}"]
+    lines += [f"{base_url}/models/model{index}.safetensors|lora{index}.safetensors" for index in range(1, args.models, 2)]
+    lines += ["#extensions"]
+    lines += [f"file://{os.path.join(workdir, 'repos', f'extension{index}.git')}" for index in range(args.extensions)]
+    path = os.path.join(workdir, "download_list.txt")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+def _local_steps(steps, names):
+    # Keep only the steps under test and drop needs on the apt/npm steps we skip
+    selected = [step for step in steps if step.description in names]
+    provided = {item for step in selected for item in step.provides}
+    for step in selected:
+        step.needs = [item for item in step.needs if item in provided]
+    return selected
+
+def run_dir(workdir, name):
+    return os.path.join(workdir, "runs", FOLLOWS.get(name, name))
+
+def run_scenario(name, ui, workdir, base_url):
+    # Runs inside a child process so peak RSS and disk can be measured per scenario.
+    # The fixtures under workdir are shared; everything a scenario writes goes under its run directory.
+    state = run_dir(workdir, name)
+    root = os.path.join(state, "root")
+    os.environ["NOTEBOOK_ROOT"] = root
+    os.makedirs(root, exist_ok=True)
+    sys.path.insert(0, os.path.join(REPO_DIR, ui))
+    ui_dir = "stable-diffusion-webui" if ui == "a1111" else "ComfyUI"
+
+    if name == "ui_stream":
+        import base
+        info = base.install_ui_stream(f"{base_url}/ui.tar.lz4", os.path.join(root, ui_dir), None)
+        return info["bytes"] > 0
+
+    if name.startswith("resource_steps"):
+        import base
+        from artifact_cache import ArtifactCache
+        base.bin_dir = os.path.join(root, "bin")
+        os.makedirs(base.bin_dir, exist_ok=True)
+        base.urls.update({
+            "cloudflared": f"{base_url}/cloudflared-linux-amd64",
+            "frp": f"{base_url}/frp_0.58.1_linux_amd64.tar.gz",
+            "zrok": f"{base_url}/zrok_0.4.23_linux_amd64.tar.gz",
+            "ui": f"{base_url}/ui.tar.lz4",
+        })
+        ui_path = os.path.join(root, ui_dir)
+        shutil.rmtree(ui_path, ignore_errors=True)
+        os.makedirs(ui_path)
+        cache = ArtifactCache(os.path.join(state, "artifact_cache"), 4 << 30)
+        steps = _local_steps(base.build_steps(root, ui_path, "master", "stream", cache),
+                             {"Install cloudflared", "Install Frp", "Install zrok", "Install UI", "Update UI"})
+        success, error, _ = base.execute_commands(steps, "Benchmark resource steps", cache=cache)
+        return error == 0
+
+    if name.startswith("custom_download"):
+        import pastebin
+        from manifest import DownloadManifest
+        custom_dirs = pastebin.create_custom_dirs()
+        entries = pastebin.read_entries(os.path.join(workdir, "download_list.txt"))
+        jobs = pastebin.build_jobs(entries, custom_dirs, "Authorization: Bearer ", "")
+        results = pastebin.custom_download(jobs)
+        models = [job for job in jobs if job.category != "extensions"]
+        extensions = [job for job in jobs if job.category == "extensions"]
+        # The first run downloads every job; the rerun finds every model in place and
+        # only runs the extension clones, which see their checkout and return at once
+        expected = extensions if name == "custom_download_rerun" else jobs
+        ran = sorted(map(id, expected)) == sorted(id(result.job) for result in results) and all(result.success for result in results)
+        manifest = DownloadManifest(pastebin.manifest_path)
+        served = os.path.join(workdir, "serve", "models")
+        print(f"{len(results)} jobs ran, {sum(not result.success for result in results)} failed")
+        return (ran and all(os.path.isfile(job.path) and os.path.getsize(job.path) == os.path.getsize(os.path.join(served, os.path.basename(job.url)))
+                            and manifest.lookup(job) for job in models)
+                and all(os.path.isdir(os.path.join(job.dst, pastebin.repo_name(job.url), ".git")) for job in extensions))
+
+    if name == "snapshot_restore":
+        import base
+        from snapshot import SnapshotStore
+        ui_path = os.path.join(root, ui_dir)
+        shutil.rmtree(ui_path, ignore_errors=True)
+        base.install_ui_stream(f"{base_url}/ui.tar.lz4", ui_path, None)
+        roots = [root for root in base.snapshot_roots(root, ui_path) if root.name in ("ui", "venv", "state")]
+        snapshots = SnapshotStore(os.path.join(state, "snapshots"))
+        snapshots.save(roots)
+        files = sum(len(names) for _, _, names in os.walk(ui_path))
+        shutil.rmtree(ui_path)
+        provided = snapshots.restore(roots)
+        restored = "ui-tree" in provided and files == sum(len(names) for _, _, names in os.walk(ui_path))
+        # The default --snapshot_skip leaves the venv out: a restore must then not stand in for Install UI
+        without_venv = SnapshotStore(os.path.join(state, "snapshots_without_venv"))
+        without_venv.save([root for root in roots if root.name != "venv"])
+        shutil.rmtree(ui_path)
+        provided = without_venv.restore(roots)
+        steps = base.skip_provided(base.build_steps(root, ui_path), provided)
+        print(f"restored without the venv: provided {sorted(provided)}")
+        return restored and "ui-tree" not in provided and any(step.description == "Install UI" for step in steps)
+
+    if name == "download_plan":
+        import pastebin
+        custom_dirs = pastebin.create_custom_dirs()
+        jobs = pastebin.build_jobs(pastebin.read_entries(os.path.join(workdir, "download_list.txt")), custom_dirs, "Authorization: Bearer ", "")
+        # One model already on disk from before there was a manifest: a dry run must not record it
+        first = next(job for job in jobs if job.category != "extensions")
+        os.makedirs(first.dst, exist_ok=True)
+        shutil.copy(os.path.join(workdir, "serve", "models", os.path.basename(first.url)), os.path.join(first.dst, first.filename))
+        pastebin.custom_download(jobs, dry_run=True)
+        # Every model size known from the probes and nothing written
+        return all(job.size for job in jobs if job.category != "extensions") and not os.path.exists(pastebin.manifest_path) and not any(
+            os.path.exists(os.path.join(job.dst, job.filename)) for job in jobs if job.filename and job is not first)
+
+    if name == "ui_update":
+        import base
+        from git_cache import update_checkout, recently_checked
+        ui_path = os.path.join(root, ui_dir)
+        shutil.rmtree(ui_path, ignore_errors=True)
+        base.install_ui_stream(f"{base_url}/ui.tar.lz4", ui_path, None)
+        # The new commit goes to a copy of the UI repo, so the shared fixture stays as the tarball has it
+        ui_bare = os.path.join(state, "ui.git")
+        for suffix in ("", ".work"):
+            shutil.copytree(os.path.join(workdir, "repos", "ui.git" + suffix), ui_bare + suffix, symlinks=True)
+        subprocess.run(["git", "remote", "set-url", "origin", ui_bare], cwd=ui_path, check=True)
+        checks = os.path.join(state, "ui_update.json")
+        # Unchanged upstream: a no-op; then one new commit upstream: fetched and checked out
+        unchanged = update_checkout(ui_path, "master", checks)
+        push_commit(ui_bare + ".work", ui_bare)
+        stale = recently_checked(ui_path, "master", checks, 3600)
+        changed = update_checkout(ui_path, "master", checks)
+        print(f"unchanged {unchanged}, changed {changed}")
+        return (not unchanged["updated"] and changed["updated"] and os.path.exists(os.path.join(ui_path, "CHANGELOG"))
+                and stale and recently_checked(ui_path, "master", checks, 3600) and not recently_checked(ui_path, "master", checks, 0))
+
+    if name == "mirror_failover":
+        import hashlib
+        from fetch import segmented_download
+        from mirrors import MirrorTable
+        serve = os.path.join(workdir, "serve")
+        size = os.path.getsize(os.path.join(serve, "download.bin"))
+        # A slow origin, a mirror that is fastest until a quarter of the file is
+        # out and then crawls, and a mirror with a steady middling rate
+        with LocalServer(serve, bandwidth=1 << 20) as origin, \
+                LocalServer(serve, bandwidth=64 << 20, throttle_after=size // 4, throttled_bandwidth=256 << 10) as fading, \
+                LocalServer(serve, bandwidth=8 << 20) as steady:
+            url = f"{origin.url}/download.bin"
+            ranked = MirrorTable({f"{origin.url}/": [f"{fading.url}/", f"{steady.url}/"]}).ranked(url)
+            target = os.path.join(root, "downloads", "mirrored.bin")
+            shutil.rmtree(os.path.dirname(target), ignore_errors=True)
+            _, sha256, _ = segmented_download(url, target, connections=8, mirrors=ranked, min_rate=4 << 20)
+        hasher = hashlib.sha256()
+        with open(os.path.join(serve, "download.bin"), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+        print(f"ranked {ranked}, sent: origin {origin.bytes_sent}, fading {fading.bytes_sent}, steady {steady.bytes_sent}")
+        return ranked[0].startswith(fading.url) and steady.bytes_sent > 0 and sha256 == hasher.hexdigest()
+
+    if name == "tunnel_race":
+        import re
+        import socket
+        from tunnel_race import TunnelRace
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        fake = f"{sys.executable} {os.path.join(BENCH_DIR, 'fake_tunnel.py')} --port {{port}}"
+        pattern = re.compile(r"http://127\.0\.0\.1:\d+")
+        race = TunnelRace(port, keep=1, url_timeout=10)
+        race.add_tunnel(f"{fake} --bandwidth_kb 512", "slow", pattern)
+        race.add_tunnel(f"{fake} --latency_ms 150", "laggy", pattern)
+        race.add_tunnel(f"{fake} --startup 0.5 --latency_ms 5", "fast", pattern)
+        race.add_tunnel(f"{sys.executable} -c 'raise SystemExit(1)'", "broken", pattern)
+        with race:
+            winners = [tunnel.name for tunnel in race.tunnels if tunnel.process.poll() is None]
+        return winners == ["fast"]
+
+    if name == "public_ip":
+        from public_ip import PublicIPLookup
+        # One slow provider, one answering garbage, one unreachable and one good one
+        with LocalServer(os.path.join(workdir, "serve"), latency=2) as slow:
+            providers = [f"{slow.url}/ip/slow", f"{base_url}/ip/garbage", "http://127.0.0.1:9/", f"{base_url}/ip/fast"]
+            cache_path = os.path.join(state, "public_ip.json")
+            start = time.time()
+            first = PublicIPLookup(providers, timeout=1, cache_path=cache_path).get()
+            raced = time.time() - start
+            cached = PublicIPLookup(["http://127.0.0.1:9/"], timeout=1, cache_path=cache_path).get(0)
+        return first == cached == "203.0.113.7" and raced < 1
+
+    if name in ("segmented_download", "aria2_download"):
+        url = f"{base_url}/download.bin"
+        target = os.path.join(root, "downloads", "download.bin")
+        shutil.rmtree(os.path.dirname(target), ignore_errors=True)
+        if name == "segmented_download":
+            from fetch import segmented_download
+            segmented_download(url, target, connections=16)
+        else:
+            subprocess.run(["aria2c", "--console-log-level=error", "-x", "16", "-s", "16", "-k", "1M",
+                            "-d", os.path.dirname(target), "-o", "download.bin", url], check=True)
+        return os.path.getsize(target) == os.path.getsize(os.path.join(workdir, "serve", "download.bin"))
+
+    raise ValueError(f"Unknown scenario {name}")
+
+def _disk_used(path):
+    stat = os.statvfs(path)
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+def measure(name, args, workdir, server):
+    log_path = os.path.join(workdir, f"{name}.log")
+    if name not in FOLLOWS:
+        shutil.rmtree(run_dir(workdir, name), ignore_errors=True)
+    os.makedirs(run_dir(workdir, name), exist_ok=True)
+    server.reset_counter()
+    disk_before = _disk_used(workdir)
+    peak_disk = 0
+    done = threading.Event()
+
+    def sample_disk():
+        nonlocal peak_disk
+        while not done.is_set():
+            peak_disk = max(peak_disk, _disk_used(workdir) - disk_before)
+            done.wait(0.05)
+
+    sampler = threading.Thread(target=sample_disk, daemon=True)
+    sampler.start()
+    start = time.time()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run_scenario", name, "--ui", args.ui,
+                                    "--workdir", workdir, "--server", server.url], stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - start
+    done.set()
+    sampler.join()
+    transferred = server.reset_counter()
+    return {
+        "ok": process.returncode == 0,
+        "wall": wall,
+        "bytes": transferred,
+        "throughput": transferred / wall if wall > 0 else 0,
+        "peak_disk": max(peak_disk, 0),
+        "peak_rss": usage.ru_maxrss * 1024,
+        "log": log_path,
+    }
+
+def compare(results, baseline_path, save):
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    elif not save:
+        print(f"No baseline at {baseline_path}, nothing to compare with; --save_baseline records one.")
+    thresholds = baseline.get("thresholds", THRESHOLDS)
+    regressions = []
+    print(f"{'scenario':<24} {'ok':<3} {'wall s':>8} {'MB/s':>8} {'disk MB':>8} {'rss MB':>8}  vs baseline")
+    for name, result in results.items():
+        notes = []
+        previous = baseline.get("results", {}).get(name)
+        if previous:
+            for metric, limit in thresholds.items():
+                if previous.get(metric):
+                    ratio = result[metric] / previous[metric]
+                    notes.append(f"{metric} {ratio - 1:+.0%}")
+                    if ratio > limit:
+                        regressions.append(f"{name}: {metric} {result[metric]:.2f} > {limit:.2f} x {previous[metric]:.2f}")
+        print(f"{name:<24} {'y' if result['ok'] else 'n':<3} {result['wall']:8.2f} {result['throughput'] / (1 << 20):8.1f} "
+              f"{result['peak_disk'] / (1 << 20):8.1f} {result['peak_rss'] / (1 << 20):8.1f}  {', '.join(notes)}")
+        if not result["ok"]:
+            regressions.append(f"{name}: failed, see {result['log']}")
+
+    if save:
+        with open(baseline_path, "w") as f:
+            json.dump({"thresholds": thresholds, "results": {name: {key: value for key, value in result.items() if key != "log"}
+                                                               for name, result in results.items()}}, f, indent=1)
+        print(f"Baseline written to {baseline_path}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline provisioning benchmark against a local HTTP server and local git repos.")
+    parser.add_argument("--ui", choices=["a1111", "cui"], default="a1111")
+    parser.add_argument("--scenarios", type=str, default=",".join(SCENARIOS), help="Comma-separated scenarios to run.")
+    parser.add_argument("--bandwidth_mb", type=float, default=0, help="Per-connection bandwidth cap in MB/s, 0 for unlimited.")
+    parser.add_argument("--latency_ms", type=float, default=0, help="Added latency before every response.")
+    parser.add_argument("--no_ranges", action="store_true", help="Serve without Range support.")
+    parser.add_argument("--fail_rate", type=float, default=0, help="Fraction of requests answered with 503.")
+    parser.add_argument("--cut_rate", type=float, default=0, help="Fraction of responses cut off halfway.")
+    parser.add_argument("--ui_mb", type=int, default=64)
+    parser.add_argument("--small_files", type=int, default=2000)
+    parser.add_argument("--models", type=int, default=4)
+    parser.add_argument("--model_mb", type=int, default=64)
+    parser.add_argument("--extensions", type=int, default=4)
+    parser.add_argument("--download_mb", type=int, default=128, help="Size of the file for the segmented/aria2 comparison.")
+    parser.add_argument("--baseline", type=str, default=os.path.join(BENCH_DIR, "baseline.json"))
+    parser.add_argument("--save_baseline", action="store_true", help="Store these results as the new baseline.")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory for inspection.")
+    parser.add_argument("--run_scenario", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--server", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        sys.exit(0 if run_scenario(args.run_scenario, args.ui, args.workdir, args.server) else 1)
+
+    workdir = tempfile.mkdtemp(prefix="sdw-bench-")
+    try:
+        build_fixtures(workdir, args)
+        server = LocalServer(os.path.join(workdir, "serve"), bandwidth=int(args.bandwidth_mb * (1 << 20)),
+                             latency=args.latency_ms / 1000, ranges=not args.no_ranges,
+                             fail_rate=args.fail_rate, cut_rate=args.cut_rate)
+        with server:
+            write_download_list(workdir, server.url, args)
+            scenarios = args.scenarios.split(",")
+            if "aria2_download" in scenarios and shutil.which("aria2c") is None:
+                print("Skipping aria2_download: aria2c is not installed")
+                scenarios.remove("aria2_download")
+            results = {}
+            for name in scenarios:
+                # A second run needs the first one's state; run that first, unreported, when it was not asked for
+                if name in FOLLOWS and FOLLOWS[name] not in results:
+                    measure(FOLLOWS[name], args, workdir, server)
+                results[name] = measure(name, args, workdir, server)
+        regressions = compare(results, args.baseline, args.save_baseline)
+    finally:
+        if args.keep:
+            print(f"Work directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
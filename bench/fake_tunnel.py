@@ -0,0 +1,57 @@
+import time
+import socket
+import argparse
+import threading
+
+# Stand-in for cloudflared/lt/zrok: forwards a local listening port to the
+# tunnelled port with an added per-chunk latency and a bandwidth cap, after
+# printing its "public" URL the way the real tools do.
+
+def pipe(source, target, bandwidth, latency):
+    sent = 0
+    began = time.time()
+    try:
+        while True:
+            chunk = source.recv(16 << 10)
+            if not chunk:
+                break
+            if latency:
+                time.sleep(latency)
+            target.sendall(chunk)
+            sent += len(chunk)
+            if bandwidth:
+                delay = sent / bandwidth - (time.time() - began)
+                if delay > 0:
+                    time.sleep(delay)
+    except OSError:
+        pass
+    finally:
+        for sock in (source, target):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, required=True, help="Local port to forward to.")
+    parser.add_argument("--startup", type=float, default=0.0, help="Seconds before the URL is printed.")
+    parser.add_argument("--latency_ms", type=float, default=0.0)
+    parser.add_argument("--bandwidth_kb", type=float, default=0.0, help="Cap in KB/s per direction, 0 for unlimited.")
+    args = parser.parse_args()
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    time.sleep(args.startup)
+    print(f"Your url is: http://127.0.0.1:{listener.getsockname()[1]}", flush=True)
+    bandwidth = args.bandwidth_kb * 1024
+    latency = args.latency_ms / 1000
+    while True:
+        client, _ = listener.accept()
+        upstream = socket.create_connection(("127.0.0.1", args.port))
+        threading.Thread(target=pipe, args=(client, upstream, bandwidth, latency), daemon=True).start()
+        threading.Thread(target=pipe, args=(upstream, client, bandwidth, latency), daemon=True).start()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import re
+import time
+import random
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK_SIZE = 64 << 10
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _resolve(self):
+        settings = self.server.settings
+        path = os.path.normpath(os.path.join(settings.root, self.path.split("?")[0].lstrip("/")))
+        if not path.startswith(settings.root) or not os.path.isfile(path):
+            return None
+        return path
+
+    def _send_headers(self):
+        settings = self.server.settings
+        if settings.latency:
+            time.sleep(settings.latency)
+        if settings.fail_rate and settings.random.random() < settings.fail_rate:
+            self.send_error(503, "Injected failure")
+            return None
+        path = self._resolve()
+        if path is None:
+            self.send_error(404)
+            return None
+
+        size = os.path.getsize(path)
+        start, end, status = 0, size - 1, 200
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match and settings.ranges:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", f'"{size:x}-{int(os.path.getmtime(path)):x}"')
+        if settings.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        return path, start, end
+
+    def do_HEAD(self):
+        self._send_headers()
+
+    def do_GET(self):
+        result = self._send_headers()
+        if result is None:
+            return
+        path, start, end = result
+        settings = self.server.settings
+        remaining = end - start + 1
+        cut_at = remaining // 2 if settings.cut_rate and settings.random.random() < settings.cut_rate else None
+        sent = 0
+        began = time.time()
+        with open(path, "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if cut_at is not None and sent + len(chunk) > cut_at:
+                    # Failure injection: drop the connection halfway through the body
+                    self.close_connection = True
+                    return
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                sent += len(chunk)
+                remaining -= len(chunk)
+                settings.count(len(chunk))
+                if settings.throttled():
+                    time.sleep(len(chunk) / settings.throttled_bandwidth)
+                elif settings.bandwidth:
+                    delay = sent / settings.bandwidth - (time.time() - began)
+                    if delay > 0:
+                        time.sleep(delay)
+
+class LocalServer:
+    # Stand-in for huggingface/civitai/GitHub releases: serves files from `root`
+    # with an optional per-connection bandwidth cap (bytes/s), added latency,
+    # Range support and injected failures (503s or connections cut halfway).
+    # Once `throttle_after` bytes have gone out in total, every connection
+    # drops to `throttled_bandwidth`, like a mirror that slows down mid-file.
+    def __init__(self, root, bandwidth=0, latency=0.0, ranges=True, fail_rate=0.0, cut_rate=0.0, seed=0,
+                 throttle_after=0, throttled_bandwidth=0):
+        self.root = os.path.abspath(root)
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.ranges = ranges
+        self.fail_rate = fail_rate
+        self.cut_rate = cut_rate
+        self.random = random.Random(seed)
+        self.throttle_after = throttle_after
+        self.throttled_bandwidth = throttled_bandwidth
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    def count(self, size):
+        with self.lock:
+            self.bytes_sent += size
+
+    def throttled(self):
+        return self.throttled_bandwidth and self.bytes_sent >= self.throttle_after
+
+    def reset_counter(self):
+        with self.lock:
+            sent, self.bytes_sent = self.bytes_sent, 0
+        return sent
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.settings = self
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def _git(*args, cwd=None):
+    env = {**os.environ, "GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@localhost",
+           "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@localhost"}
+    subprocess.run(["git", *args], cwd=cwd, env=env, check=True, capture_output=True)
+
+def make_bare_repo(path, files=20, commits=3, branch="master"):
+    # A bare repo with a little history, standing in for an extension or the UI repo
+    work = path + ".work"
+    os.makedirs(work, exist_ok=True)
+    _git("init", "-q", "-b", branch, cwd=work)
+    for commit in range(commits):
+        for index in range(files):
+            with open(os.path.join(work, f"file{index}.py"), "w") as f:
+                f.write(f"# commit {commit}\n" + "x = 1\n" * (index + 1) * 10)
+        _git("add", "-A", cwd=work)
+        _git("commit", "-q", "-m", f"commit {commit}", cwd=work)
+    _git("clone", "-q", "--bare", work, path)
+    return path, work
+
+def push_commit(work, path, message="upstream change"):
+    with open(os.path.join(work, "CHANGELOG"), "a") as f:
+        f.write(message + "\n")
+    _git("add", "-A", cwd=work)
+    _git("commit", "-q", "-m", message, cwd=work)
+    _git("push", "-q", path, "HEAD", cwd=work)
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from dataclasses import dataclass
+from fetch import open_mirrored, head, save_stream
+from persist import free_space
+
+@dataclass
+class Artifact:
+    url: str
+    path: str
+    version: str = None
+    mode: int = None
+    sha256: str = None  # pinned digest; only a pinned artifact may come from a mirror
+
+    def verify(self):
+        if self.sha256 is None:
+            return
+        hasher = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+        if hasher.hexdigest() != self.sha256:
+            os.remove(self.path)
+            raise ValueError(f"{os.path.basename(self.path)} does not match its pinned sha256 {self.sha256}")
+
+def _format_size(size):
+    return f"{size / (1 << 20):.1f} MB"
+
+class _TeeReader:
+    # Hands the response through to the caller while writing it into the cache;
+    # the blob is only committed when the body was read to the end. A cache
+    # write that fails (a full disk) drops the copy, never the download.
+    def __init__(self, cache, response, key, url, version):
+        self.cache = cache
+        self.response = response
+        self.key = key
+        self.url = url
+        self.version = version
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.eof = False
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.blob_dir, suffix=".tmp")
+        self.tmp = os.fdopen(fd, "wb")
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        if data:
+            if self.tmp:
+                try:
+                    self.tmp.write(data)
+                except OSError:
+                    self._drop()
+            self.hasher.update(data)
+            self.size += len(data)
+        elif size != 0:
+            self.eof = True
+        return data
+
+    def _drop(self):
+        tmp, self.tmp = self.tmp, None
+        try:
+            tmp.close()
+        except OSError:
+            pass
+        os.remove(self.tmp_path)
+
+    def close(self):
+        self.response.close()
+        if self.tmp:
+            try:
+                self.tmp.close()
+            except OSError:
+                self._drop()
+        if self.eof and self.tmp:
+            try:
+                self.cache._commit(self.key, self.url, self.version, self.tmp_path, self.hasher.hexdigest(), self.size)
+            except OSError:
+                pass
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ArtifactCache:
+    # Downloads keyed by URL + version (or the server's ETag), stored once per
+    # content hash and evicted least-recently-used beyond `budget` bytes. A
+    # download larger than the budget or the free disk space is not cached.
+    def __init__(self, root, budget):
+        self.root = root
+        self.budget = budget
+        self.blob_dir = os.path.join(root, "blobs")
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def _key(self, url, version):
+        return hashlib.sha256(f"{url}\n{version or ''}".encode()).hexdigest()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp, self.index_path)
+
+    def _resolve_version(self, url, headers):
+        try:
+            response_headers = head(url, headers=headers)
+            return response_headers.get("ETag") or response_headers.get("Last-Modified")
+        except OSError:
+            # Offline or the server refuses HEAD: fall back to the newest copy we hold
+            entries = [entry for entry in self.index.values() if entry["url"] == url]
+            return max(entries, key=lambda entry: entry["last_used"])["version"] if entries else None
+
+    def _lookup(self, key):
+        entry = self.index.get(key)
+        if entry and os.path.exists(self._blob_path(entry["sha256"])):
+            return entry
+        return None
+
+    def _commit(self, key, url, version, tmp_path, digest, size):
+        with self.lock:
+            if size > self.budget:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, self._blob_path(digest))
+            self.index[key] = {"url": url, "version": version, "sha256": digest, "size": size, "last_used": time.time()}
+            self._evict(keep=key)
+            self._save_index()
+
+    def _evict(self, keep):
+        referenced = {}
+        for entry in self.index.values():
+            referenced[entry["sha256"]] = entry["size"]
+        total = sum(referenced.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+            del self.index[key]
+            if all(other["sha256"] != entry["sha256"] for other in self.index.values()):
+                total -= entry["size"]
+                try:
+                    os.remove(self._blob_path(entry["sha256"]))
+                except OSError:
+                    pass
+
+    def open(self, url, version=None, headers=None, mirrors=None, min_rate=0):
+        if version is None:
+            version = self._resolve_version(url, headers)
+        key = self._key(url, version)
+        with self.lock:
+            entry = self._lookup(key)
+            if entry:
+                entry["last_used"] = time.time()
+                self.hits += 1
+                self.bytes_saved += entry["size"]
+                self._save_index()
+                return open(self._blob_path(entry["sha256"]), "rb")
+            self.misses += 1
+        response = open_mirrored(url, mirrors, headers, min_rate)
+        length = response.headers.get("Content-Length")
+        if length and int(length) > min(self.budget, free_space(self.blob_dir)):
+            return response
+        return _TeeReader(self, response, key, url, version)
+
+    def fetch(self, artifact, headers=None, mirrors=None, min_rate=0):
+        with self.open(artifact.url, artifact.version, headers=headers, mirrors=mirrors, min_rate=min_rate) as source:
+            save_stream(source, artifact.path, artifact.mode)
+
+    def summary(self):
+        return f"Cache: {self.hits} hits, {self.misses} misses, {_format_size(self.bytes_saved)} saved"
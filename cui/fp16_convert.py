@@ -0,0 +1,140 @@
+import os
+import json
+import mmap
+import time
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from colablib.colored_print import cprint
+from model_index import read_header
+
+CHUNK_ELEMENTS = 16 << 20  # 64 MB of fp32 in, 32 MB of fp16 out per step
+EMA_PREFIXES = ("model_ema.",)
+
+def _tensors(header):
+    # (name, info) in file order, which is also the order the data is laid out in
+    items = [(name, info) for name, info in header.items() if name != "__metadata__"]
+    return sorted(items, key=lambda item: item[1]["data_offsets"][0])
+
+def _plan(header, drop_ema):
+    new_header = {}
+    if "__metadata__" in header:
+        new_header["__metadata__"] = header["__metadata__"]
+    offset = 0
+    layout = []
+    for name, info in _tensors(header):
+        if drop_ema and name.startswith(EMA_PREFIXES):
+            continue
+        begin, end = info["data_offsets"]
+        dtype = "F16" if info["dtype"] == "F32" else info["dtype"]
+        size = (end - begin) // 2 if dtype != info["dtype"] else end - begin
+        new_header[name] = {"dtype": dtype, "shape": info["shape"], "data_offsets": [offset, offset + size]}
+        layout.append((name, info["dtype"], begin, end))
+        offset += size
+    return new_header, layout
+
+def _encode_header(header):
+    data = json.dumps(header, separators=(",", ":")).encode()
+    # Pad with spaces so the tensor data starts 8-byte aligned, as the reference writer does
+    data += b" " * (-len(data) % 8)
+    return struct.pack("<Q", len(data)) + data
+
+def verify(source_header, path, drop_ema):
+    header = read_header(path)
+    expected = {name: info["shape"] for name, info in _tensors(source_header) if not (drop_ema and name.startswith(EMA_PREFIXES))}
+    actual = {name: info["shape"] for name, info in _tensors(header)}
+    if expected != actual:
+        raise ValueError("tensor names or shapes differ after conversion")
+    with open(path, "rb") as f:
+        length, = struct.unpack("<Q", f.read(8))
+    data_end = max((info["data_offsets"][1] for _, info in _tensors(header)), default=0)
+    if os.path.getsize(path) != 8 + length + data_end:
+        raise ValueError("converted file has the wrong size")
+
+def convert_to_fp16(path, drop_ema=False):
+    # Streams every F32 tensor through numpy in bounded chunks of a read-only
+    # mmap, writes next to the original and only replaces it after checking
+    # names and shapes. Returns the bytes saved and the sha256 of the new file,
+    # or (0, None) when no tensor would change and the file was left alone.
+    import numpy as np
+    header = read_header(path)
+    if not any(info["dtype"] == "F32" or (drop_ema and name.startswith(EMA_PREFIXES)) for name, info in _tensors(header)):
+        return 0, None
+    new_header, layout = _plan(header, drop_ema)
+    with open(path, "rb") as f:
+        data_start = 8 + struct.unpack("<Q", f.read(8))[0]
+    tmp = path + ".fp16.tmp"
+    hasher = hashlib.sha256()
+    try:
+        with open(path, "rb") as source, open(tmp, "wb") as out:
+            def write(data):
+                hasher.update(data)
+                out.write(data)
+            write(_encode_header(new_header))
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                for name, dtype, begin, end in layout:
+                    begin += data_start
+                    end += data_start
+                    if dtype != "F32":
+                        for offset in range(begin, end, CHUNK_ELEMENTS * 4):
+                            write(view[offset:min(offset + CHUNK_ELEMENTS * 4, end)])
+                        continue
+                    for offset in range(begin, end, CHUNK_ELEMENTS * 4):
+                        # Slicing copies the chunk out, so no buffer into the mmap outlives it
+                        values = np.frombuffer(view[offset:min(offset + CHUNK_ELEMENTS * 4, end)], dtype="<f4")
+                        with np.errstate(over="ignore"):
+                            half = values.astype("<f2")
+                        if np.isinf(half).sum() != np.isinf(values).sum():
+                            raise ValueError(f"{name} has values outside the fp16 range")
+                        write(half.tobytes())
+        verify(header, tmp, drop_ema)
+        saved = os.path.getsize(path) - os.path.getsize(tmp)
+        os.replace(tmp, path)
+        return saved, hasher.hexdigest()
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class ConversionStage:
+    # Converts finished checkpoint downloads on its own worker while the
+    # download engine keeps going; the manifest is updated so a converted
+    # file still counts as downloaded on the next run. With a model store the
+    # file is only added once it is converted, so the blob is what the UI loads.
+    def __init__(self, manifest, drop_ema=False, workers=1, tracer=None, store=None):
+        self.manifest = manifest
+        self.store = store
+        self.drop_ema = drop_ema
+        self.tracer = tracer
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+
+    def _convert(self, job, sha256):
+        start = time.time()
+        try:
+            saved, converted = convert_to_fp16(job.path, self.drop_ema)
+        except (OSError, ValueError, KeyError) as e:
+            cprint(f"Warning: {job.filename} was left as it is, fp16 conversion failed: {e}", color="flat_yellow")
+            saved, converted = 0, None
+        entry = self.manifest.lookup(job) or {}
+        etag, source_size = entry.get("etag"), entry.get("source_size")
+        # Whenever the file was rewritten, even to the same size, its hash changed with it
+        if converted is not None:
+            sha256, source_size = converted, source_size or entry.get("size")
+            self.manifest.record(job, os.path.getsize(job.path), sha256, etag, source_size=source_size)
+        if self.store and self.store.add(job, sha256):
+            cprint(f"    {job.filename} has the same content as a stored file, keeping one copy.", color="flat_green")
+            self.manifest.record(job, os.path.getsize(job.path), sha256, etag, source_size=source_size)
+        if self.tracer:
+            self.tracer.add(f"fp16 {job.filename}", "convert", start, time.time(), bytes=saved)
+        return saved
+
+    def submit(self, job, sha256=None):
+        self.futures.append(self.executor.submit(self._convert, job, sha256))
+
+    def finish(self):
+        self.executor.shutdown(wait=True)
+        saved = [future.result() for future in self.futures]
+        if saved:
+            cprint(f"[+] Converted {sum(1 for size in saved if size)} of {len(saved)} checkpoints to fp16, "
+                   f"saved {sum(saved) / (1 << 20):.1f} MB.", color="flat_green")
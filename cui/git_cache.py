@@ -0,0 +1,142 @@
+import os
+import re
+import json
+import time
+import hashlib
+import subprocess
+import threading
+from collections import deque
+
+_locks = {}
+_locks_guard = threading.Lock()
+# "Receiving objects:  45% (450/1000), 1.20 MiB | 2.30 MiB/s"
+RECEIVED = re.compile(r"Receiving objects:.*?, ([\d.]+) (bytes|KiB|MiB|GiB)")
+UNITS = {"bytes": 1, "KiB": 1 << 10, "MiB": 1 << 20, "GiB": 1 << 30}
+
+def repo_name(url):
+    name = os.path.basename(url.rstrip("/"))
+    return name[:-4] if name.endswith(".git") else name
+
+def _git(*args, cwd=None, progress=None):
+    if progress is not None:
+        return _git_progress(*args, cwd=cwd, progress=progress)
+    result = subprocess.run(["git", *args], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"git {args[0]} failed: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+def _git_progress(*args, cwd=None, progress=None):
+    # clone/fetch with --progress; `progress` is called with each increase of
+    # the bytes received, the rest of stderr is kept for the error message
+    process = subprocess.Popen(["git", args[0], "--progress", *args[1:]], cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    reported = 0
+    pending = b""
+    tail = deque(maxlen=20)
+    with process.stderr:
+        for chunk in iter(lambda: os.read(process.stderr.fileno(), 65536), b""):
+            *lines, pending = re.split(rb"[\r\n]", pending + chunk)
+            for line in lines:
+                text = line.decode("utf-8", "replace").strip()
+                match = RECEIVED.search(text)
+                if match:
+                    received = int(float(match.group(1)) * UNITS[match.group(2)])
+                    if received > reported:
+                        progress(received - reported)
+                        reported = received
+                elif text:
+                    tail.append(text)
+    if process.wait() != 0:
+        raise RuntimeError(f"git {args[0]} failed: {' '.join(tail)}")
+    return ""
+
+def _lock_for(path):
+    with _locks_guard:
+        return _locks.setdefault(path, threading.Lock())
+
+def mirror_path(cache_dir, url):
+    digest = hashlib.sha1(url.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{repo_name(url)}-{digest}.git")
+
+def update_mirror(url, cache_dir, branch=None, depth=1, progress=None):
+    # A shallow, single-branch bare mirror that survives between sessions;
+    # refreshing it only transfers what changed upstream.
+    mirror = mirror_path(cache_dir, url)
+    with _lock_for(mirror):
+        if not os.path.isdir(mirror):
+            os.makedirs(cache_dir, exist_ok=True)
+            args = ["clone", "--bare", "--single-branch", f"--depth={depth}"]
+            if branch:
+                args.append(f"--branch={branch}")
+            _git(*args, url, mirror, progress=progress)
+        else:
+            ref = f"refs/heads/{branch}" if branch else _git("symbolic-ref", "HEAD", cwd=mirror)
+            _git("fetch", f"--depth={depth}", "--force", url, f"+{ref}:{ref}", cwd=mirror, progress=progress)
+    return mirror
+
+def clone(url, dst, cache_dir=None, branch=None, depth=1, progress=None):
+    # Shallow single-branch clone into dst/<repo name>. With a cache the clone
+    # is made from the local mirror (hardlinked objects when on the same
+    # filesystem) and origin is pointed back at the real URL afterwards.
+    # `progress` is called with the bytes received from the network.
+    target = os.path.join(dst, repo_name(url))
+    if os.path.isdir(os.path.join(target, ".git")):
+        return target
+    os.makedirs(dst, exist_ok=True)
+    if cache_dir is None:
+        args = ["clone", "--single-branch", f"--depth={depth}"]
+        if branch:
+            args.append(f"--branch={branch}")
+        _git(*args, url, target, progress=progress)
+        return target
+
+    mirror = update_mirror(url, cache_dir, branch, depth, progress)
+    with _lock_for(mirror):
+        _git("clone", "--single-branch", mirror, target)
+    _git("remote", "set-url", "origin", url, cwd=target)
+    return target
+
+def _load_checks(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def recently_checked(path, branch, state_path, ttl):
+    # True when `path` is still at the commit that matched the remote less
+    # than `ttl` seconds ago; no network and no work-tree scan
+    entry = _load_checks(state_path).get(os.path.abspath(path))
+    if not entry or entry["branch"] != branch or time.time() - entry["checked"] >= ttl:
+        return False
+    try:
+        return _git("rev-parse", "HEAD", cwd=path) == entry["head"]
+    except (OSError, RuntimeError):
+        return False
+
+def _record_check(state_path, path, branch, head):
+    checks = _load_checks(state_path)
+    checks[os.path.abspath(path)] = {"branch": branch, "head": head, "checked": time.time()}
+    tmp = state_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(checks, f, indent=1)
+    os.replace(tmp, state_path)
+
+def update_checkout(path, branch, state_path=None, remote="origin", depth=1):
+    # Brings the checkout at `path` to the tip of the remote's `branch`: one
+    # ls-remote, and only when that names another commit a shallow fetch of
+    # it and a checkout, which rewrites just the paths that differ. The result
+    # goes to `state_path` for recently_checked. Returns the trace info.
+    head = _git("rev-parse", "HEAD", cwd=path)
+    listed = _git("ls-remote", remote, f"refs/heads/{branch}", cwd=path)
+    if not listed:
+        raise RuntimeError(f"{remote} has no branch {branch}")
+    target = listed.split()[0]
+    if target != head or _git("rev-parse", "--abbrev-ref", "HEAD", cwd=path) != branch:
+        if target != head:
+            _git("fetch", f"--depth={depth}", remote, f"+refs/heads/{branch}:refs/remotes/{remote}/{branch}", cwd=path)
+        _git("checkout", "--force", "-B", branch, target, cwd=path)
+        if target != head:
+            _git("branch", f"--set-upstream-to={remote}/{branch}", branch, cwd=path)
+    if state_path:
+        _record_check(state_path, path, branch, target)
+    return {"head": target[:12], "updated": target != head}
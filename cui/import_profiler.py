@@ -0,0 +1,70 @@
+import sys
+import time
+import atexit
+import builtins
+import threading
+
+_original_import = builtins.__import__
+_local = threading.local()
+records = []
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    start = time.perf_counter()
+    stack.append(0.0)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        # Same two columns as `python -X importtime`: self time and cumulative time
+        records.append((name, len(stack), elapsed - children, elapsed))
+
+OPTIONS = ("--profile_imports", "--profile-imports")
+
+def requested(argv):
+    # Checked before argparse runs, so it accepts the same abbreviations argparse does
+    return any(len(arg) > 2 and option.startswith(arg) for arg in argv for option in OPTIONS)
+
+def install():
+    builtins.__import__ = _timed_import
+    # The scripts uninstall it when their run ends; these cover a run that
+    # raised before getting there, at module level or while importing
+    atexit.register(uninstall)
+    shell = _shell()
+    if shell is not None:
+        shell.events.register("post_run_cell", _uninstall_after_cell)
+
+def _shell():
+    # The notebooks %run the scripts, so the hook would outlive them in the kernel
+    if "IPython" not in sys.modules:
+        return None
+    from IPython import get_ipython
+    return get_ipython()
+
+def _uninstall_after_cell(result=None):
+    uninstall()
+    _shell().events.unregister("post_run_cell", _uninstall_after_cell)
+
+def uninstall():
+    # Safe to call whether or not the hook is on, and leaves any other hook alone
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _original_import
+
+def report(top=20):
+    from colablib.colored_print import cprint
+    if builtins.__import__ is not _timed_import:
+        return
+    uninstall()
+    if not records:
+        return
+    total = sum(cumulative for _, depth, _, cumulative in records if depth == 0)
+    cprint(f"[+] Imports took {total:.2f} secs, slowest modules:", color="flat_yellow")
+    for name, depth, self_time, cumulative in sorted(records, key=lambda record: record[3], reverse=True)[:top]:
+        cprint(f"    {cumulative * 1000:9.1f} ms  (self {self_time * 1000:8.1f} ms)  {'  ' * depth}{name}", color="flat_cyan")
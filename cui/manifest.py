@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import threading
+from download_engine import strip_credentials
+
+class DownloadManifest:
+    # One entry per (destination dir, URL): final filename, size, ETag, sha256
+    # and the mtime the file had when it was recorded. A read-only manifest (a
+    # dry run) still answers lookups but never writes the file.
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        # Older runs keyed civitai entries on URLs that still had the API key in them
+        for key in [key for key in self.entries if strip_credentials(key.partition("|")[2])[1]]:
+            entry = self.entries.pop(key)
+            entry["url"] = strip_credentials(entry["url"])[0]
+            self.entries[f"{key.partition('|')[0]}|{entry['url']}"] = entry
+
+    def _key(self, job):
+        return f"{job.dst}|{job.url}"
+
+    def lookup(self, job):
+        return self.entries.get(self._key(job))
+
+    def is_current(self, job):
+        # Cheap check only: size and mtime on disk, plus ETag/size from the HEAD probe when known
+        entry = self.lookup(job)
+        if entry is None and job.filename and job.size is not None:
+            # Downloaded before there was a manifest: trust a size match with the server
+            path = os.path.join(job.dst, job.filename)
+            if os.path.isfile(path) and os.path.getsize(path) == job.size:
+                self.record(job, job.size, None, job.etag)
+                return True
+        if entry is None or (job.filename and job.filename not in (entry["filename"], os.path.splitext(entry["filename"])[0])):
+            return False
+        path = os.path.join(job.dst, entry["filename"])
+        if entry.get("extracted"):
+            if not all(os.path.exists(os.path.join(job.dst, name)) for name in entry["extracted"]):
+                return False
+            # An archive deleted after extraction: what it unpacked stands in for it
+            if not os.path.exists(path):
+                job.filename = entry["filename"]
+                return True
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != entry["size"] or int(stat.st_mtime) != entry["mtime"]:
+            return False
+        if job.etag and entry["etag"] and job.etag != entry["etag"]:
+            return False
+        # A file converted after download no longer has the size the server reports
+        if job.size is not None and job.size != (entry.get("source_size") or entry["size"]):
+            return False
+        job.filename = entry["filename"]
+        return True
+
+    def record(self, job, size, sha256, etag, source_size=None, extracted=None):
+        entry = {
+            "url": job.url,
+            "filename": job.filename,
+            "size": size,
+            "source_size": source_size,
+            "etag": etag,
+            "sha256": sha256,
+            "extracted": extracted,
+            "mtime": int(os.stat(job.path).st_mtime) if os.path.exists(job.path) else None,
+            "recorded": time.time(),
+        }
+        with self.lock:
+            self.entries[self._key(job)] = entry
+            if self.read_only:
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp, self.path)
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from colablib.colored_print import cprint
+from fetch import open_url, CHUNK_SIZE
+
+# URL prefix -> prefixes serving the same paths. Off unless --mirrors or
+# NOTEBOOK_MIRRORS asks for it: "default" for this table, or a JSON file
+# (or inline JSON object) of the same shape. base.py never takes executables
+# from a mirror unless their sha256 is pinned and checked.
+DEFAULT_MIRRORS = {
+    "https://huggingface.co/": ["https://hf-mirror.com/"],
+    "https://github.com/": ["https://ghfast.top/https://github.com/", "https://gh-proxy.com/https://github.com/"],
+}
+PROBE_BYTES = 256 << 10
+
+def _format_rate(rate):
+    return f"{rate / (1 << 20):.1f} MB/s" if rate else "no answer"
+
+def probe(url, headers=None, timeout=5):
+    # (bytes per second, total size) of a short range request, timed from the
+    # request on so a slow handshake counts against the source; (None, None) on failure
+    start = time.time()
+    try:
+        with open_url(url, headers={**(headers or {}), "Range": f"bytes=0-{PROBE_BYTES - 1}"}, timeout=timeout) as response:
+            received = 0
+            while received < PROBE_BYTES:
+                chunk = response.read(min(CHUNK_SIZE, PROBE_BYTES - received))
+                if not chunk:
+                    break
+                received += len(chunk)
+            content_range = response.headers.get("Content-Range", "")
+            length = response.headers.get("Content-Length")
+    except (OSError, ValueError):
+        return None, None
+    elapsed = time.time() - start
+    if response.status == 206 and "/" in content_range and not content_range.endswith("/*"):
+        size = int(content_range.rsplit("/", 1)[1])
+    else:
+        size = int(length) if length else None
+    return (received / elapsed if received and elapsed > 0 else None), size
+
+class MirrorTable:
+    def __init__(self, table):
+        self.table = table
+        self.lock = threading.Lock()
+        self.orders = {}  # prefix -> its candidate prefixes, fastest first, from the first file probed
+
+    @classmethod
+    def load(cls, spec=""):
+        spec = spec or os.environ.get("NOTEBOOK_MIRRORS", "")
+        if not spec:
+            return cls({})
+        if spec == "default":
+            return cls(DEFAULT_MIRRORS)
+        if spec.lstrip().startswith("{"):
+            return cls(json.loads(spec))
+        with open(spec) as f:
+            return cls(json.load(f))
+
+    def _prefix(self, url):
+        return max((prefix for prefix in self.table if url.startswith(prefix)), key=len, default=None)
+
+    def candidates(self, url):
+        prefix = self._prefix(url)
+        if prefix is None:
+            return [url]
+        return [url] + [mirror + url[len(prefix):] for mirror in self.table[prefix]]
+
+    def ranked(self, url, headers=None):
+        # The URLs to fetch `url` from, fastest first, or None when it has no
+        # mirrors. The first file under a prefix is probed on every candidate
+        # at once; later files reuse that order. Credentials only go to the
+        # original host, and a candidate reporting another size is dropped.
+        prefix = self._prefix(url)
+        if prefix is None:
+            return None
+        bases = [prefix] + self.table[prefix]
+        with self.lock:
+            order = self.orders.get(prefix)
+            if order is None:
+                order = self.orders[prefix] = self._rank(url, headers, bases)
+        return [base + url[len(prefix):] for base in order]
+
+    def _rank(self, url, headers, bases):
+        prefix = bases[0]
+        urls = [base + url[len(prefix):] for base in bases]
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            results = list(executor.map(lambda candidate: probe(candidate, headers if candidate == url else None), urls))
+        sizes = [size for _, size in results if size]
+        expected = results[0][1] or (max(set(sizes), key=sizes.count) if sizes else None)
+        order = []
+        for base, (rate, size) in zip(bases, results):
+            if size and expected and size != expected:
+                cprint(f"    mirror {base} serves a different file, skipped", color="flat_yellow")
+                continue
+            order.append((rate or 0, base))
+        # Sources that did not answer stay at the end as a last resort
+        order.sort(key=lambda item: -item[0])
+        cprint(f"[+] Mirrors for {prefix}: " + ", ".join(f"{base} {_format_rate(rate)}" for rate, base in order), color="flat_cyan")
+        return [base for _, base in order]
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from colablib.colored_print import cprint
+
+MAX_HEADER = 100 << 20
+
+def read_header(path):
+    # A .safetensors file starts with a little-endian u64 header length and
+    # that many bytes of JSON; the tensor data after it is never touched.
+    with open(path, "rb") as f:
+        prefix = f.read(8)
+        if len(prefix) != 8:
+            raise ValueError("file too short")
+        length, = struct.unpack("<Q", prefix)
+        if length > MAX_HEADER:
+            raise ValueError(f"header of {length} bytes")
+        return json.loads(f.read(length))
+
+def _any(keys, *prefixes):
+    return any(key.startswith(prefixes) for key in keys)
+
+def detect(header):
+    # (type, architecture) from tensor names and the training metadata
+    metadata = header.get("__metadata__") or {}
+    keys = [key for key in header if key != "__metadata__"]
+    base = (metadata.get("ss_base_model_version") or metadata.get("modelspec.architecture") or "").lower()
+
+    if _any(keys, "lora_") or any(".lora_down." in key or ".lora_A." in key for key in keys):
+        if "flux" in base or _any(keys, "lora_unet_double_blocks", "transformer.single_transformer_blocks"):
+            return "lora", "flux"
+        if "xl" in base or _any(keys, "lora_te2_", "lora_te1_"):
+            return "lora", "sdxl"
+        return "lora", "sd1"
+    if _any(keys, "control_model.", "input_hint_block.", "controlnet_cond_embedding."):
+        return "controlnet", "sdxl" if _any(keys, "control_model.label_emb.") else "sd"
+    if _any(keys, "model.diffusion_model."):
+        if _any(keys, "model.diffusion_model.double_blocks."):
+            return "checkpoint", "flux"
+        if _any(keys, "model.diffusion_model.joint_blocks."):
+            return "checkpoint", "sd3"
+        if _any(keys, "conditioner.embedders.1."):
+            return "checkpoint", "sdxl"
+        if _any(keys, "cond_stage_model.model."):
+            return "checkpoint", "sd2"
+        return "checkpoint", "sd1"
+    if _any(keys, "double_blocks.", "single_blocks."):
+        return "unet", "flux"
+    if keys and all(key.startswith(("encoder.", "decoder.", "quant_conv.", "post_quant_conv.")) for key in keys):
+        return "vae", "sd"
+    if keys and len(keys) <= 2 and (_any(keys, "emb_params", "clip_l", "clip_g", "string_to_param")):
+        return "embedding", "sdxl" if _any(keys, "clip_g") else "sd1"
+    return "unknown", None
+
+def summarize(path):
+    header = read_header(path)
+    dtypes = {}
+    params = 0
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtypes[info["dtype"]] = dtypes.get(info["dtype"], 0) + 1
+        count = 1
+        for dim in info["shape"]:
+            count *= dim
+        params += count
+    kind, arch = detect(header)
+    return {"tensors": sum(dtypes.values()), "dtypes": dtypes, "params": params, "type": kind, "arch": arch}
+
+class ModelIndex:
+    # Header facts per file, reused while size and mtime are unchanged
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, path):
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, **summarize(path)}
+        with self.lock:
+            self.entries[path] = entry
+        return entry
+
+    def move(self, old, new):
+        with self.lock:
+            entry = self.entries.pop(old, None)
+            if entry:
+                self.entries[new] = {**entry, "mtime": os.stat(new).st_mtime_ns}
+
+    def save(self):
+        with self.lock:
+            self.entries = {path: entry for path, entry in self.entries.items() if os.path.exists(path)}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, separators=(",", ":"))
+            os.replace(tmp, self.path)
+
+def _safetensors(path):
+    for root, _, names in os.walk(path, followlinks=True):
+        for name in names:
+            if name.endswith(".safetensors"):
+                yield os.path.join(root, name)
+
+def index_models(custom_dirs, category_types, index_path, route=False, workers=16):
+    # custom_dirs maps category -> CustomDirs (dst), category_types maps the
+    # categories that hold one kind of model to that type ("lora", "vae", ...).
+    start_time = time.time()
+    index = ModelIndex(index_path)
+    home = {kind: custom_dirs[category].dst for category, kind in category_types.items()}
+    files = [(category, path) for category in category_types for path in _safetensors(custom_dirs[category].dst)]
+
+    def inspect(item):
+        category, path = item
+        try:
+            return category, path, index.get(path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            cprint(f"Warning: could not read the header of {path}: {e}", color="flat_yellow")
+            return category, path, None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(inspect, files))
+
+    results = [result for result in results if result[2] is not None]
+    misplaced = 0
+    total = 0
+    for category, path, entry in results:
+        total += entry["size"]
+        expected = category_types[category]
+        if entry["type"] in (expected, "unknown") or entry["type"] not in home:
+            continue
+        misplaced += 1
+        target = os.path.join(home[entry["type"]], os.path.basename(path))
+        if route and not os.path.exists(target):
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+                index.move(path, target)
+                cprint(f"[+] Moved {os.path.basename(path)}, a {entry['type']} ({entry['arch']}), from {category} to {target}", color="flat_yellow")
+                continue
+            except OSError as e:
+                cprint(f"Warning: could not move {path}: {e}", color="flat_yellow")
+        cprint(f"Warning: {path} looks like a {entry['type']} ({entry['arch']}), not a {expected}.", color="flat_yellow")
+    index.save()
+    cprint(f"[+] Indexed {len(results)} safetensors files ({total / (1 << 30):.1f} GB) in {time.time() - start_time:.2f} secs, "
+           f"{misplaced} misplaced.", color="flat_green" if not misplaced else "flat_yellow")
+    return results
@@ -0,0 +1,92 @@
+import os
+import re
+import time
+import threading
+from collections import deque
+from colablib.colored_print import cprint
+
+# Matches the usual progress noise: "45%", "12.3MiB/s", "Receiving objects: 10/200"
+PROGRESS = re.compile(r"\d+(\.\d+)?\s?%|\d+(\.\d+)?\s?[KMG]i?B/s|\b\d+/\d+\b")
+
+print_lock = threading.Lock()
+
+def emit(text, color=None):
+    # cprint writes text and newline separately; holding one lock keeps lines
+    # from concurrent steps from being spliced together
+    with print_lock:
+        cprint(text, color=color)
+
+class OutputCapture:
+    # Reads a child's stdout/stderr line by line as it runs. Only the last
+    # `tail_lines` lines are kept (for error reports); progress lines are
+    # collapsed and echoed at most every `progress_interval` seconds.
+    def __init__(self, label, echo=False, tail_lines=40, progress_interval=2.0):
+        self.label = label
+        self.echo = echo
+        self.tail = deque(maxlen=tail_lines)
+        self.progress_interval = progress_interval
+        self.progress_lines = 0
+        self.last_progress = None
+        self.last_progress_echo = 0.0
+        self.lock = threading.Lock()
+        self.readers = []
+
+    def _line(self, line, color, carriage):
+        line = line.rstrip()
+        if not line:
+            return
+        if carriage or PROGRESS.search(line):
+            with self.lock:
+                self.progress_lines += 1
+                self.last_progress = line
+                due = time.time() - self.last_progress_echo >= self.progress_interval
+                if due:
+                    self.last_progress_echo = time.time()
+            if self.echo and due:
+                emit(f"      [{self.label}] {line}", color="flat_cyan")
+            return
+        with self.lock:
+            self.tail.append(line)
+        if self.echo:
+            emit(f"      [{self.label}] {line}", color=color)
+
+    def _pump(self, pipe, color):
+        pending = b""
+        with pipe:
+            for chunk in iter(lambda: os.read(pipe.fileno(), 65536), b""):
+                pending += chunk
+                # \r-terminated lines are in-place progress updates (apt, pip, git, curl)
+                while True:
+                    match = re.search(rb"[\r\n]", pending)
+                    if match is None:
+                        break
+                    end = match.start()
+                    carriage = pending[end:end + 2] != b"\r\n" and pending[end:end + 1] == b"\r"
+                    self._line(pending[:end].decode("utf-8", "replace"), color, carriage)
+                    pending = pending[end + 1:]
+                if len(pending) > 65536:
+                    # A single line that never ends; keep only its start
+                    pending = pending[:4096]
+            if pending:
+                self._line(pending.decode("utf-8", "replace"), color, False)
+
+    def attach(self, pipe, color):
+        reader = threading.Thread(target=self._pump, args=(pipe, color), daemon=True)
+        reader.start()
+        self.readers.append(reader)
+
+    def join(self):
+        for reader in self.readers:
+            reader.join()
+        if self.last_progress is not None:
+            self.tail.append(self.last_progress)
+
+    def summary(self):
+        if not self.progress_lines:
+            return None
+        return f"{self.progress_lines} progress updates, last: {self.last_progress}"
+
+    def report(self, color="flat_red"):
+        with print_lock:
+            for line in self.tail:
+                cprint(f"      [{self.label}] {line}", color=color)
@@ -1,15 +1,32 @@
+import sys
+import import_profiler
+if import_profiler.requested(sys.argv[1:]):
+    import_profiler.install()
 import os
 import time
 import argparse
+import itertools
+from dataclasses import dataclass
 from colablib.utils import py_utils
-from pydantic import BaseModel
 from colablib.utils.py_utils import get_filename
-from colablib.sd_models.downloader import aria2_download, download
 from colablib.colored_print import cprint, print_line
-from colablib.utils.config_utils import read_config
-from colablib.utils.git_utils import clone_repo
+from download_engine import DownloadEngine, DownloadJob, host_of, probe_sizes, print_summary, strip_credentials
+from manifest import DownloadManifest
+from model_index import index_models
+from fp16_convert import ConversionStage
+from model_store import ModelStore, etag_sha256
+from fetch import segmented_download, extract_archive, is_archive, content_filename
+from planner import DiskBudget, DownloadPlan, ThroughputHistory, measure_rates, space_needed, job_name
+from mirrors import MirrorTable
+from progress import ProgressBoard
+from git_cache import clone, repo_name
+from persist import persist_dir, persist_budget, room
+from tracing import Tracer
 
 def detect_environment():
+    # NOTEBOOK_ROOT lets the scripts run on a plain Linux box, e.g. for the benchmarks
+    if os.environ.get('NOTEBOOK_ROOT'):
+        return os.environ['NOTEBOOK_ROOT'], "Local"
     iskaggle = os.environ.get('KAGGLE_KERNEL_RUN_TYPE', '')
     iscolab = 'COLAB_GPU' in os.environ
     if iscolab:
@@ -59,8 +76,19 @@ vae_dir             = os.path.join(webui_path, "models", "vae")
 vae_approx_dir      = os.path.join(webui_path, "models", "vae_approx")
 extension_dir       = os.path.join(webui_path, "custom_nodes")
 download_list       = os.path.join(root_path, "download_list.txt")
+manifest_path       = os.path.join(root_path, "download_manifest.json")
+model_index_path    = os.path.join(root_path, "model_index.json")
+model_store_dir     = os.path.join(root_path, "model_store")
+throughput_path     = os.path.join(root_path, "download_speeds.json")
+git_cache_dir       = persist_dir(root_path, env, ".git_cache")
 
-class CustomDirs(BaseModel):
+UI_NAME = "cui"  # column of model_store.CATEGORY_MAP
+
+# Categories that hold a single kind of model, checked by the header index
+MODEL_TYPES = {"checkpoints": "checkpoint", "vae": "vae", "loras": "lora", "embeddings": "embedding", "controlnet": "controlnet"}
+
+@dataclass
+class CustomDirs:
     url: str
     dst: str
 
@@ -84,67 +112,182 @@ def create_custom_dirs():
         "extensions"           : CustomDirs(url=custom_extensions_url, dst=extension_dir)
     }
 
-def parse_urls(filename):
-    content = read_config(filename)
-    lines   = content.strip().split('\n')
-    result  = {}
-    key     = ''
+def parse_entries(lines):
+    # One pass over the list: "#category" headers, "//" comments and
+    # comma-separated "url" or "url|filename" entries
+    category = None
     for line in lines:
-        if not line.strip():
-            continue
-        if line.startswith('//'):
+        line = line.strip()
+        if not line or line.startswith('//'):
             continue
         if line.startswith('#'):
-            key = line[1:].lower()
-            result[key] = []
-        else:
-            urls = [url.strip() for url in line.split(',') if url.strip() != '']
-            result[key].extend(urls)
-    return result
-
-def custom_download(custom_dirs, user_header, civitai_api_key):
-    for key, value in custom_dirs.items():
-        urls     = value.url.split(",")  # Split the comma-separated URLs
-        dst      = value.dst
-
-        if value.url:
-            print_line(0, color="green")
-            cprint(f" [+] Downloading {key}.", color="flat_yellow")
-
-        for url in urls:
-            url = url.strip()  # Remove leading/trailing whitespaces from each URL
-            if url != "":
-                print_line(0, color="green")
-                if "|" in url:
-                    url, filename = map(str.strip, url.split("|"))
-                    if not filename.endswith((".safetensors", ".ckpt", ".pt", "pth")):
-                        filename = filename + os.path.splitext(get_filename(url))[1]
-                else:
-                    if not url.startswith("fuse:"):
-                        filename = get_filename(url)
+            category = line[1:].strip().lower()
+            continue
+        for entry in line.split(','):
+            url, _, filename = entry.partition('|')
+            url = url.strip()
+            if url:
+                yield category, url, filename.strip() or None
+
+def read_entries(filename):
+    with open(filename, encoding="utf-8") as f:
+        yield from parse_entries(f)
+
+def auth_headers(url, user_header, civitai_api_key=None):
+    # Keys travel as headers, so they never end up in job.url and with it the
+    # manifest, the model store index, the traces or the snapshots
+    name, _, value = user_header.partition(":")
+    if host_of(url) == "huggingface.co" and value.strip() != "Bearer":
+        return {name.strip(): value.strip()}
+    if host_of(url) == "civitai.com" and civitai_api_key:
+        return {"Authorization": f"Bearer {civitai_api_key}"}
+    return None
 
-                if url.startswith("fuse:"):
-                    fuse(url, key, dst)
-                elif key == "extensions":
-                    clone_repo(url, cwd=dst)
+def _dedupe_key(category, url):
+    # The same repo is often pasted with and without ".git" or a trailing slash
+    if category == "extensions":
+        url = url.rstrip("/").removesuffix(".git")
+    return url
+
+def build_jobs(entries, custom_dirs, user_header, civitai_api_key):
+    # Every URL is queued once, under the first category it appears in; an
+    # explicit filename already claimed in the same folder is skipped as well.
+    jobs = []
+    seen = {}
+    paths = set()
+    unknown = set()
+    for category, url, filename in entries:
+        url, pasted_key = strip_credentials(url)
+        if category not in custom_dirs:
+            if category not in unknown:
+                unknown.add(category)
+                if category is None:
+                    cprint("Warning: URLs before the first #category line are ignored.", color="flat_yellow")
                 else:
-                    download(url=url, filename=filename, user_header=user_header, dst=dst, quiet=False)
-
-def download_from_textfile(filename, custom_dirs, civitai_api_key):
-    for key, urls in parse_urls(filename).items():
-        for url in urls:
-            if "civitai.com" in url:
-                url += f"&ApiKey={civitai_api_key}" if "?" in url else f"?ApiKey={civitai_api_key}"
-        key_lower = key.lower()
-        if key_lower in custom_dirs:
-            if custom_dirs[key_lower].url:
-                custom_dirs[key_lower].url += ',' + ','.join(urls)
-            else:
-                custom_dirs[key_lower].url = ','.join(urls)
+                    cprint(f"Warning: Category '{category}' from the file is not found in custom_dirs.", color="flat_yellow")
+            continue
+        key = _dedupe_key(category, url)
+        if key in seen:
+            if seen[key] != category:
+                cprint(f"Warning: {url} is listed under both '{seen[key]}' and '{category}', keeping '{seen[key]}'.", color="flat_yellow")
+            continue
+        dst = custom_dirs[category].dst
+        if filename:
+            if (dst, filename) in paths:
+                cprint(f"Warning: {category}/{filename} is listed twice, skipping {url}.", color="flat_yellow")
+                continue
+            paths.add((dst, filename))
+        seen[key] = category
+        jobs.append(DownloadJob(category=category, url=url, filename=filename,
+                                dst=dst, auth=auth_headers(url, user_header, pasted_key or civitai_api_key)))
+    return jobs
+
+def remote_filename(job):
+    # get_filename asks without credentials; a keyed civitai download needs them
+    return content_filename(job.url, job.auth) if job.auth else get_filename(job.url)
+
+def custom_entries(custom_dirs):
+    # URLs set directly on the custom_*_url variables come before the list file
+    for category, value in custom_dirs.items():
+        yield from parse_entries([f"#{category}", value.url])
+
+def run_job(job, manifest, converter=None, connections=8, store=None, extract=False, delete_archives=False, mirrors=None, min_rate=0,
+            board=None, git_cache=None):
+    # Progress goes to the board's one live display instead of a banner per file
+    task = board.add(f"{job.category}: {job_name(job)}", job.size) if board else None
+    success = False
+    try:
+        _run_job(job, manifest, converter, connections, store, extract, delete_archives, mirrors, min_rate, task, git_cache)
+        success = True
+    finally:
+        if task:
+            task.finish(success)
+
+def _run_job(job, manifest, converter, connections, store, extract, delete_archives, mirrors, min_rate, task, git_cache):
+    progress = task.advance if task else None
+    if job.url.startswith("fuse:"):
+        fuse(job.url, job.category, job.dst)
+    elif job.category == "extensions":
+        job.filename = repo_name(job.url)
+        clone(job.url, job.dst, cache_dir=git_cache, progress=progress)
+    else:
+        entry = manifest.lookup(job)
+        if job.filename:
+            if not job.filename.endswith((".safetensors", ".ckpt", ".pt", "pth")):
+                job.filename = job.filename + os.path.splitext(remote_filename(job))[1]
+        elif entry:
+            job.filename = entry["filename"]
         else:
-            cprint(f"Warning: Category '{key}' from the file is not found in custom_dirs.", color="flat_yellow")
+            job.filename = remote_filename(job)
+        sha256 = store.lookup(job) if store else None
+        if sha256:
+            cprint(f"    {job.filename} is already in the model store, linking it.", color="flat_green")
+            manifest.record(job, store.link_into(sha256, job.path), sha256, job.etag)
+            return
+        size, sha256, etag = segmented_download(job.url, job.path, headers=job.auth, etag=job.etag, connections=connections,
+                                                mirrors=mirrors.ranked(job.url, job.auth) if mirrors else None, min_rate=min_rate,
+                                                progress=progress)
+        # Bytes from a mirror are only as good as the origin's hash of them
+        if etag_sha256(job.etag) and sha256 != etag_sha256(job.etag):
+            os.remove(job.path)
+            raise OSError(f"{job.filename} does not match the sha256 {etag_sha256(job.etag)} its origin reports")
+        manifest.record(job, size, sha256, etag)
+        if extract and is_archive(job.filename):
+            if task:
+                task.phase("extract", size)
+            extracted = extract_archive(job.path, job.dst, progress=progress)
+            if delete_archives:
+                os.remove(job.path)
+            manifest.record(job, size, sha256, etag, extracted=extracted)
+            cprint(f"    Extracted {len(extracted)} entries from {job.filename}" + (" and deleted it." if delete_archives else "."), color="flat_green")
+            return
+        # A checkpoint to convert goes into the store after the conversion: the
+        # conversion replaces the file, which would leave the blob holding the fp32 bytes
+        if converter and MODEL_TYPES.get(job.category) == "checkpoint" and job.filename.endswith(".safetensors"):
+            converter.submit(job, sha256)
+        elif store and store.add(job, sha256):
+            cprint(f"    {job.filename} has the same content as a stored file, keeping one copy.", color="flat_green")
+            manifest.record(job, size, sha256, etag)
+
+def custom_download(jobs, max_workers=4, tracer=None, fp16=False, drop_ema=False, connections=8, store=None,
+                    extract=False, delete_archives=False, dry_run=False, mirrors=None, min_rate=0, events_path=None):
+    # Returns a JobResult for every job that ran; files already in place are skipped and not in it
+    if not jobs:
+        return []
+    probe_sizes(jobs)
+    manifest = DownloadManifest(manifest_path, read_only=dry_run)
+    present = {job for job in jobs if job.category != "extensions" and not job.url.startswith("fuse:") and manifest.is_current(job)}
+    if present:
+        cprint(f"[+] Skipping {len(present)} files that are already downloaded.", color="flat_yellow")
+    jobs = [job for job in jobs if job not in present]
+    extract = extract or delete_archives
+    stored = {job for job in jobs if store and store.lookup(job)}
+    needed = lambda job: space_needed(job, extract, stored)
+    history = ThroughputHistory(throughput_path)
+    DownloadPlan(jobs, needed, measure_rates(jobs, history)).print()
+    if dry_run:
+        return []
+    start_time = time.time()
+    converter = ConversionStage(manifest, drop_ema, tracer=tracer, store=store) if fp16 else None
+    git_cache = git_cache_dir
+    # The git cache shares the persistent disk budget with the snapshots and the artifact cache
+    shared = [persist_dir(root_path, env, ".artifact_cache"), persist_dir(root_path, env, ".snapshots")]
+    if any(job.category == "extensions" for job in jobs) and not room(git_cache_dir, persist_budget(), shared):
+        cprint("[+] The persistent disk budget is used up, cloning extensions without the git cache.", color="flat_yellow")
+        git_cache = None
+    with ProgressBoard(len(jobs), sum(job.size or 0 for job in jobs), events_path=events_path) as board:
+        worker = lambda job: run_job(job, manifest, converter, connections, store, extract, delete_archives, mirrors, min_rate, board, git_cache)
+        results = DownloadEngine(max_workers=max_workers).run(jobs, worker, tracer=tracer, budget=DiskBudget(needed))
+    print_line(0, color="green")
+    print_summary(results, time.time() - start_time)
+    history.update(results)
+    history.save()
+    if converter:
+        converter.finish()
+    return results
 
 def custom_download_list(url, root_path, user_header):
+    from colablib.sd_models.downloader import download
     filename = "custom_download_list.txt"
     filepath = os.path.join(root_path, filename)
     if os.path.exists(filepath):
@@ -155,25 +298,66 @@ def custom_download_list(url, root_path, user_header):
     download(url=url, filename=filename, user_header=user_header, dst=root_path, quiet=True)
     return filepath
 
-def main(pastebin_url, hf_token, civitai_api_key):
+def main(pastebin_url, hf_token, civitai_api_key, max_workers=4, trace_path=None, route_models=False, fp16=False, drop_ema=False, connections=8,
+         extract=False, delete_archives=False, dry_run=False, mirrors="", min_rate=0, events_path=None):
     start_time = time.time()
     textfile_path = download_list
     custom_dirs = create_custom_dirs()
     user_header = f"Authorization: Bearer {hf_token}"
     if pastebin_url:
         textfile_path = custom_download_list(pastebin_url, root_path, user_header)
-    download_from_textfile(textfile_path, custom_dirs, civitai_api_key)
-    custom_download(custom_dirs, user_header, civitai_api_key)
+    store = ModelStore(model_store_dir, UI_NAME)
+    if not dry_run:
+        store.populate(custom_dirs)
+    entries = itertools.chain(custom_entries(custom_dirs), read_entries(textfile_path))
+    jobs = build_jobs(entries, custom_dirs, user_header, civitai_api_key)
+    tracer = Tracer("download")
+    custom_download(jobs, max_workers, tracer, fp16, drop_ema, connections, store, extract, delete_archives, dry_run,
+                    MirrorTable.load(mirrors), int(min_rate * (1 << 20)), events_path)
+    if dry_run:
+        return
+    index_models(custom_dirs, MODEL_TYPES, model_index_path, route=route_models)
+    if trace_path:
+        tracer.write(trace_path)
 
     elapsed_time = py_utils.calculate_elapsed_time(start_time)
     print_line(0, color="green")
     cprint(f"[+] Download completed within {elapsed_time}.", color="flat_yellow")
 
+def positive_int(value):
+    # 0 workers or connections would finish at once, having downloaded nothing
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download script with pastebin URL and HF token.")
     parser.add_argument("--pastebin_url", type=str, required=True, help="The Pastebin URL.")
     parser.add_argument("--hf_token", type=str, required=True, help="The Hugging Face token.")
     parser.add_argument("--civitai_api_key", type=str, required=True, help="The CivitAI API key.")
+    parser.add_argument("--max_workers", type=positive_int, default=4, help="How many files are downloaded at the same time.")
+    parser.add_argument("--connections", type=positive_int, default=8, help="Parallel range requests per file.")
+    parser.add_argument("--route_models", action="store_true", help="Move files whose headers show they are in the wrong category "
+                        "(keep the list in sync, or they are downloaded again next run).")
+    parser.add_argument("--fp16", action="store_true", help="Convert downloaded fp32 .safetensors checkpoints to fp16.")
+    parser.add_argument("--drop_ema", action="store_true", help="Also drop EMA weights while converting.")
+    parser.add_argument("--extract_archives", action="store_true", help="Unpack downloaded .zip and tar archives into their folder.")
+    parser.add_argument("--delete_archives", action="store_true", help="Unpack archives and delete each one right after (implies --extract_archives).")
+    parser.add_argument("--dry_run", action="store_true", help="Print the sizes, free space and time estimate without downloading anything.")
+    parser.add_argument("--mirrors", type=str, default="", help='Mirror table: "default" for the built-in huggingface/github mirrors, '
+                        "or a JSON file mapping URL prefixes to mirror prefixes (default: $NOTEBOOK_MIRRORS, else off).")
+    parser.add_argument("--min_rate", type=float, default=0, help="Switch to the next mirror when a file arrives slower than this many MB/s.")
+    parser.add_argument("--progress_events", type=str, default=None, help="Append progress as newline-delimited JSON events to this file.")
+    parser.add_argument("--trace", type=str, default="download_trace.json", help="Where to write the Chrome trace of the downloads.")
+    parser.add_argument("--profile_imports", "--profile-imports", action="store_true", help="Report the time spent importing each module.")
 
-    args = parser.parse_args()
-    main(args.pastebin_url, args.hf_token, args.civitai_api_key)
+    try:
+        args = parser.parse_args()
+        main(args.pastebin_url, args.hf_token, args.civitai_api_key, args.max_workers, args.trace, args.route_models, args.fp16, args.drop_ema, args.connections,
+             args.extract_archives, args.delete_archives, args.dry_run, args.mirrors, args.min_rate, args.progress_events)
+        if args.profile_imports:
+            import_profiler.report()
+    finally:
+        # Installed before anything else ran; a run that raised must not leave it on in the kernel
+        import_profiler.uninstall()
@@ -0,0 +1,53 @@
+import os
+import shutil
+
+# Kaggle keeps /kaggle/working between sessions, but only up to 20 GB, and the
+# snapshots, the artifact cache and the git cache all default to it. They share
+# one budget (NOTEBOOK_PERSIST_BUDGET_GB, 16 GB unless set) so that no one of
+# them can fill the directory up for the others.
+DEFAULT_BUDGET_GB = 16
+FREE_MARGIN = 1 << 30  # left free on the disk whatever the budget says
+
+def persist_dir(ui, env, name):
+    return os.path.join("/kaggle/working" if env == "Kaggle" else ui, name)
+
+def persist_budget(budget_gb=None):
+    if budget_gb is None:
+        budget_gb = float(os.environ.get("NOTEBOOK_PERSIST_BUDGET_GB", DEFAULT_BUDGET_GB))
+    return int(budget_gb * (1 << 30))
+
+def dir_size(path):
+    # Bytes allocated under path; a file hardlinked under several names counts once
+    total = 0
+    seen = set()
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(directory, name))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            total += stat.st_blocks * 512
+    return total
+
+def existing_parent(path):
+    # The directory may not exist yet; its nearest existing parent is on the same disk
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+def free_space(path):
+    # What may be written there, FREE_MARGIN already kept back for the WebUI, pip and the logs
+    return shutil.disk_usage(existing_parent(path)).free - FREE_MARGIN
+
+def room(path, budget=None, shared=()):
+    # Bytes that may still be written under path: the free space less the
+    # margin, and at most what the budget leaves after path and the `shared`
+    # directories that count against the same budget
+    available = free_space(path)
+    if budget is not None:
+        available = min(available, budget - sum(dir_size(other) for other in (path, *shared)))
+    return max(available, 0)
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from colablib.colored_print import cprint
+
+# Read order: checkpoints (newest first, ComfyUI has no saved default), then VAEs, then LoRAs
+MODEL_DIRS = [
+    ("checkpoint", os.path.join("models", "checkpoints")),
+    ("vae", os.path.join("models", "vae")),
+    ("lora", os.path.join("models", "loras")),
+]
+MODEL_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin")
+SEGMENT_SIZE = 64 << 20
+READ_SIZE = 8 << 20
+
+def available_memory():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def _model_files(path):
+    files = []
+    for root, _, names in os.walk(path, followlinks=True):
+        for name in names:
+            if name.endswith(MODEL_EXTENSIONS):
+                full = os.path.join(root, name)
+                try:
+                    stat = os.stat(full)
+                except OSError:
+                    continue
+                files.append((full, stat.st_size, stat.st_mtime))
+    # Newest first: the file just downloaded is the one most likely to be used
+    return sorted(files, key=lambda item: item[2], reverse=True)
+
+def default_checkpoint(ui_path):
+    # The WebUI stores its selection as "name.safetensors [hash]" in config.json
+    try:
+        with open(os.path.join(ui_path, "config.json")) as f:
+            selected = json.load(f).get("sd_model_checkpoint", "")
+    except (OSError, ValueError):
+        return None
+    return selected.split(" [")[0] or None
+
+def plan(ui_path, budget):
+    # (path, size) in priority order, cut off where the memory budget runs out
+    selected = default_checkpoint(ui_path)
+    ordered = []
+    for category, rel in MODEL_DIRS:
+        files = _model_files(os.path.join(ui_path, rel))
+        if category == "checkpoint" and selected:
+            target = os.path.join(ui_path, rel, selected)
+            files.sort(key=lambda item: item[0] != target)
+        ordered += [(path, size) for path, size, _ in files]
+    chosen, skipped, total = [], [], 0
+    for path, size in ordered:
+        if total + size <= budget:
+            chosen.append((path, size))
+            total += size
+        else:
+            skipped.append((path, size))
+    return chosen, skipped
+
+def _warm_segment(path, offset, length):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        # The hint alone is not honoured by every filesystem (FUSE, overlay);
+        # reading through makes sure the pages are resident
+        buffer = bytearray(READ_SIZE)
+        view = memoryview(buffer)
+        os.lseek(fd, offset, os.SEEK_SET)
+        remaining = length
+        while remaining > 0:
+            read = os.readv(fd, [view[:min(READ_SIZE, remaining)]])
+            if not read:
+                break
+            remaining -= read
+        return length - remaining
+    finally:
+        os.close(fd)
+
+def prewarm(files, workers=4):
+    # Files are cut into segments queued in priority order, so all workers
+    # finish the first file before moving on to the next one.
+    segments = [(path, offset, min(SEGMENT_SIZE, size - offset)) for path, size in files for offset in range(0, size, SEGMENT_SIZE)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_warm_segment, *segment) for segment in segments]
+    warmed = 0
+    for future in futures:
+        try:
+            warmed += future.result()
+        except OSError:
+            pass
+    return warmed
+
+class Prewarmer:
+    # Runs in the background while the WebUI boots; `fraction` of the
+    # currently available memory is the most it will pull into the cache.
+    def __init__(self, ui_path, fraction=0.5, workers=4):
+        self.ui_path = ui_path
+        self.budget = int(available_memory() * fraction)
+        self.workers = workers
+        self.thread = None
+
+    def run(self):
+        start_time = time.time()
+        files, skipped = plan(self.ui_path, self.budget)
+        if not files:
+            return
+        warmed = prewarm(files, self.workers)
+        elapsed = time.time() - start_time
+        speed = warmed / elapsed / (1 << 20) if elapsed > 0 else 0
+        message = f"[+] Prewarmed {len(files)} model files ({warmed / (1 << 30):.1f} GB) in {elapsed:.1f} secs at {speed:.0f} MB/s"
+        if skipped:
+            message += f", {len(skipped)} left out of the {self.budget / (1 << 30):.1f} GB budget"
+        cprint(message + ".", color="flat_green")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+def start_prewarm(ui_path, fraction=0.5, workers=4):
+    return Prewarmer(ui_path, fraction, workers).start()
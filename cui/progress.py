@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+
+BAR_WIDTH = 20
+
+def _format_size(size):
+    if size >= 1 << 30:
+        return f"{size / (1 << 30):.1f} GB"
+    return f"{size / (1 << 20):.1f} MB"
+
+def _format_time(seconds):
+    if seconds >= 3600:
+        return f"{seconds // 3600:.0f}h{seconds % 3600 // 60:02.0f}m"
+    if seconds >= 60:
+        return f"{seconds // 60:.0f}m{seconds % 60:02.0f}s"
+    return f"{seconds:.0f}s"
+
+def _kernel_display():
+    # An IPython kernel (the notebooks %run the scripts) can update one output in place
+    if "IPython" not in sys.modules:
+        return None
+    from IPython import get_ipython
+    from IPython.display import display
+    shell = get_ipython()
+    if shell is None or not hasattr(shell, "kernel"):
+        return None
+    return display
+
+class ProgressTask:
+    # One job on the board. Bytes passed to advance count toward the board's
+    # total while the task is in its first phase (the download); later phases
+    # (extracting, say) only move the task's own bar.
+    def __init__(self, board, name, total):
+        self.board = board
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.phase_name = "download"
+        self.counted = True
+        self.start = time.time()
+
+    def advance(self, size):
+        with self.board.lock:
+            self.done += size
+            if self.counted:
+                self.board.done += size
+                if self.total is None or self.done > self.total:
+                    # Bytes nobody planned for (a clone, a size the probe got wrong)
+                    self.board.expected += size
+
+    def phase(self, name, total=None):
+        with self.board.lock:
+            self.board._settle(self)
+            self.phase_name, self.total, self.done, self.counted = name, total, 0, False
+            self.start = time.time()
+            self.board._event("phase", task=self.name, phase=name, total=total)
+
+    def finish(self, success=True):
+        with self.board.lock:
+            self.board._settle(self)
+            self.board.active.remove(self)
+            self.board.finished += 1
+            self.board.failed += not success
+            self.board._event("finish", task=self.name, success=success)
+
+class _StdoutProxy:
+    # While the board owns the bottom of a terminal, anything else printed
+    # clears the live block first so it scrolls up above it instead of being drawn over
+    def __init__(self, board, stream):
+        self.board = board
+        self.stream = stream
+
+    def write(self, text):
+        with self.board.render_lock:
+            self.board._erase()
+            return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class ProgressBoard:
+    # One live display for every running job: total bytes, aggregate rate, ETA
+    # and a bar per job, redrawn at most every `interval` seconds with at most
+    # `rows` bars, so its cost does not grow with the number of jobs. In a
+    # notebook it updates one output in place, on a terminal it redraws the
+    # last lines, and anywhere else it prints a status line every `log_interval`.
+    # With `events_path` every change is also appended there as one JSON line.
+    def __init__(self, count=0, total=0, interval=0.5, rows=6, log_interval=10.0, events_path=None, window=10.0):
+        self.count = count
+        self.expected = total
+        self.interval = interval
+        self.rows = rows
+        self.log_interval = log_interval
+        self.window = window
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.active = []
+        self.done = 0
+        self.finished = 0
+        self.failed = 0
+        self.samples = deque()
+        self.drawn = 0
+        self.last_log = 0.0
+        self.handle = None
+        self.stdout = None
+        self.stop = threading.Event()
+        self.thread = None
+        self.events = open(events_path, "a", buffering=1) if events_path else None
+
+    def _event(self, event, **fields):
+        if self.events:
+            self.events.write(json.dumps({"time": round(time.time(), 3), "event": event, **fields}) + "\n")
+
+    def _settle(self, task):
+        # A task leaving its counted phase no longer owes what it did not download
+        if task.counted and task.total:
+            self.expected -= max(task.total - task.done, 0)
+        task.counted = False
+
+    def add(self, name, total=None):
+        task = ProgressTask(self, name, total)
+        with self.lock:
+            self.active.append(task)
+            self._event("start", task=name, total=total)
+        return task
+
+    def _rate(self, now):
+        self.samples.append((now, self.done))
+        while len(self.samples) > 2 and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        (first, done_then), (last, done_now) = self.samples[0], self.samples[-1]
+        return (done_now - done_then) / (last - first) if last > first else 0
+
+    def _snapshot(self):
+        now = time.time()
+        with self.lock:
+            rate = self._rate(now)
+            remaining = max(self.expected - self.done, 0)
+            state = {
+                "done": self.done, "expected": self.expected, "rate": rate, "finished": self.finished, "failed": self.failed,
+                "running": len(self.active), "eta": remaining / rate if rate and remaining else None,
+                # Largest remaining first: those decide the ETA
+                "tasks": [(task.name, task.phase_name, task.done, task.total, task.done / max(now - task.start, 1e-6))
+                          for task in sorted(self.active, key=lambda task: (task.total or 0) - task.done, reverse=True)],
+            }
+            self._event("progress", **{key: value for key, value in state.items() if key != "tasks"},
+                        tasks=[{"task": name, "phase": phase, "done": done, "total": total} for name, phase, done, total, _ in state["tasks"]])
+        return state
+
+    def _summary(self, state):
+        total = f"/{_format_size(state['expected'])}" if state["expected"] else ""
+        eta = f" | ETA {_format_time(state['eta'])}" if state["eta"] else ""
+        failed = f", {state['failed']} failed" if state["failed"] else ""
+        return (f"[+] {state['finished']}/{self.count or state['finished'] + state['running']} done{failed}, {state['running']} running | "
+                f"{_format_size(state['done'])}{total} | {state['rate'] / (1 << 20):.1f} MB/s{eta}")
+
+    def _lines(self, state):
+        lines = [self._summary(state)]
+        for name, phase, done, total, rate in state["tasks"][:self.rows]:
+            if total:
+                filled = min(int(BAR_WIDTH * done / total), BAR_WIDTH)
+                bar = f"[{'#' * filled}{'.' * (BAR_WIDTH - filled)}] {min(done / total, 1):4.0%}"
+                amount = f"{_format_size(done)}/{_format_size(total)}"
+            else:
+                bar = f"[{'?' * BAR_WIDTH}]     "
+                amount = _format_size(done)
+            lines.append(f"    {name[:40]:<40} {phase:<8} {bar} {amount:>19} {rate / (1 << 20):6.1f} MB/s")
+        if len(state["tasks"]) > self.rows:
+            lines.append(f"    ... and {len(state['tasks']) - self.rows} more")
+        return lines
+
+    def _erase(self):
+        if self.drawn:
+            self.stdout.stream.write(f"\x1b[{self.drawn}F\x1b[J")
+            self.drawn = 0
+
+    def render(self, final=False):
+        state = self._snapshot()
+        with self.render_lock:
+            if self.handle is not None:
+                self.handle.update({"text/plain": "\n".join(self._lines(state))}, raw=True)
+            elif self.stdout is not None:
+                self._erase()
+                lines = self._lines(state)
+                self.stdout.stream.write("\n".join(lines) + "\n")
+                self.stdout.stream.flush()
+                self.drawn = len(lines)
+            elif final or time.time() - self.last_log >= self.log_interval:
+                self.last_log = time.time()
+                print(self._summary(state), flush=True)
+
+    def _loop(self):
+        while not self.stop.wait(self.interval):
+            self.render()
+
+    def __enter__(self):
+        display = _kernel_display()
+        if display is not None:
+            self.handle = display({"text/plain": ""}, raw=True, display_id=True)
+        elif sys.stdout.isatty() and os.environ.get("TERM") != "dumb":
+            self.stdout = sys.stdout = _StdoutProxy(self, sys.stdout)
+        self.last_log = time.time()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.render(final=True)
+        if self.stdout is not None:
+            sys.stdout = self.stdout.stream
+            self.stdout = None
+        if self.events:
+            self.events.close()
@@ -0,0 +1,150 @@
+import time
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from colablib.colored_print import cprint
+
+@dataclass(eq=False)
+class Step:
+    command: str
+    description: str
+    needs: list = field(default_factory=list)
+    provides: list = field(default_factory=list)
+    pool: str = None
+    debug: bool = False
+    artifacts: list = field(default_factory=list)
+    check: object = None  # postcondition probe; a step whose probe passes need not run
+
+@dataclass
+class StepResult:
+    step: Step
+    success: bool
+    start: float
+    end: float
+
+    @property
+    def elapsed(self):
+        return self.end - self.start
+
+def resolve_dependencies(steps):
+    producers = {}
+    for step in steps:
+        for item in step.provides:
+            if item in producers:
+                raise ValueError(f"'{item}' is provided by both [{producers[item].description}] and [{step.description}]")
+            producers[item] = step
+
+    deps = {}
+    for step in steps:
+        missing = [item for item in step.needs if item not in producers]
+        if missing:
+            raise ValueError(f"[{step.description}] needs {missing}, which no step provides")
+        deps[step] = {producers[item] for item in step.needs}
+
+    # Kahn's algorithm, only to reject cycles before anything is started
+    indegree = {step: len(deps[step]) for step in steps}
+    queue = [step for step in steps if indegree[step] == 0]
+    seen = 0
+    while queue:
+        current = queue.pop()
+        seen += 1
+        for step in steps:
+            if current in deps[step]:
+                indegree[step] -= 1
+                if indegree[step] == 0:
+                    queue.append(step)
+    if seen != len(steps):
+        cycle = [step.description for step in steps if indegree[step] > 0]
+        raise ValueError(f"Dependency cycle between steps: {cycle}")
+    return deps
+
+def skip_provided(steps, provided):
+    # Drops the steps whose every output is already there (restored from a
+    # snapshot, say) and the needs other steps had on those outputs
+    kept = [step for step in steps if not step.provides or not set(step.provides) <= provided]
+    for step in kept:
+        step.needs = [item for item in step.needs if item not in provided]
+    return kept
+
+def skip_satisfied(steps, workers=8):
+    # Runs every postcondition probe at once and drops the steps whose probe
+    # passes, as though they had just run. Returns (steps to run, skipped steps).
+    probed = [step for step in steps if step.check]
+
+    def probe(step):
+        try:
+            return bool(step.check())
+        except (OSError, ValueError, subprocess.SubprocessError):
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        satisfied = [step for step, passed in zip(probed, executor.map(probe, probed)) if passed]
+    provided = {item for step in satisfied for item in step.provides}
+    return skip_provided([step for step in steps if step not in satisfied], provided), satisfied
+
+def run_steps(steps, runner, max_workers=4, pool_limits=None):
+    # Every step starts as soon as the steps it needs have finished. A failed
+    # step still releases its dependents, same as the old phased run which
+    # never stopped early. `pool_limits` caps how many steps of one pool run
+    # at once (e.g. a single apt/dpkg transaction at a time).
+    pool_limits = pool_limits or {}
+    for pool, limit in pool_limits.items():
+        if limit < 1:
+            raise ValueError(f"pool {pool} would never run a step: its limit is {limit}")
+    deps = resolve_dependencies(steps)
+    pending = list(steps)
+    running = {}
+    results = {}
+    pool_usage = Counter()
+
+    def runnable(step):
+        if not deps[step] <= results.keys():
+            return False
+        if step.pool is None:
+            return True
+        return pool_usage[step.pool] < pool_limits.get(step.pool, max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for step in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if not runnable(step):
+                    continue
+                pending.remove(step)
+                pool_usage[step.pool] += 1
+                running[executor.submit(runner, step)] = (step, time.time())
+            if not running:
+                # Nothing to wait for would make wait() return at once, forever
+                raise RuntimeError(f"no step can start: {', '.join(step.description for step in pending)}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step, start = running.pop(future)
+                pool_usage[step.pool] -= 1
+                try:
+                    success = bool(future.result()[0])
+                except Exception as exc:
+                    cprint(f"Step [{step.description}] generated an exception: {exc}", color="flat_red")
+                    success = False
+                results[step] = StepResult(step, success, start, time.time())
+
+    return [results[step] for step in steps], deps
+
+def critical_path(results, deps):
+    if not results:
+        return []
+    by_step = {result.step: result for result in results}
+    path = [max(results, key=lambda result: result.end)]
+    while deps[path[-1].step]:
+        # The dependency that finished last is the one that held this step back
+        path.append(max((by_step[dep] for dep in deps[path[-1].step]), key=lambda result: result.end))
+    return path[::-1]
+
+def print_critical_path(results, deps):
+    path = critical_path(results, deps)
+    if not path:
+        return
+    chain = " -> ".join(f"{result.step.description} ({result.elapsed:.2f}s)" for result in path)
+    cprint(f"[+] Critical path: {chain} = {path[-1].end - path[0].start:.2f} secs", color="flat_yellow")
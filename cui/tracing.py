@@ -0,0 +1,55 @@
+import os
+import json
+import time
+import threading
+from colablib.colored_print import cprint
+
+class Tracer:
+    # Collects one complete event per setup step or downloaded file and writes
+    # them as Chrome trace-event JSON (chrome://tracing, ui.perfetto.dev).
+    def __init__(self, name):
+        self.name = name
+        self.origin = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+        self.lanes = {}
+
+    def _lane(self):
+        ident = threading.get_ident()
+        with self.lock:
+            return self.lanes.setdefault(ident, len(self.lanes) + 1)
+
+    def add(self, name, category, start, end, **args):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self.origin) * 1e6),
+            "dur": round((end - start) * 1e6),
+            "pid": 1,
+            "tid": self._lane(),
+            "args": {key: value for key, value in args.items() if value is not None},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, path):
+        trace = {
+            "traceEvents": self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {"name": self.name, "started": self.origin},
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(trace, f)
+
+    def print_summary(self):
+        cprint(f"    {'wall s':>8} {'exit':>4} {'cpu s':>7} {'rss MB':>7} {'MB':>9}  step", color="flat_cyan")
+        for event in sorted(self.events, key=lambda event: event["dur"], reverse=True):
+            args = event["args"]
+            cpu = f"{args['cpu']:.2f}" if "cpu" in args else "-"
+            rss = f"{args['max_rss'] / (1 << 20):.0f}" if "max_rss" in args else "-"
+            transferred = f"{args['bytes'] / (1 << 20):.1f}" if "bytes" in args else "-"
+            exit_code = args.get("exit", "-")
+            cprint(f"    {event['dur'] / 1e6:8.2f} {exit_code:>4} {cpu:>7} {rss:>7} {transferred:>9}  {event['name']}",
+                   color="flat_green" if exit_code in (0, "-") else "flat_red")